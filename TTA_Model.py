@@ -11,6 +11,7 @@ from keras import backend as K
 from keras.applications import InceptionV3
 from pprint import pprint
 from tqdm import tqdm
+from rhythm_shards import ShardReader, is_store
 
 class TTA_Model():
     """A simple TTA wrapper for keras computer vision models.
@@ -32,6 +33,7 @@ class TTA_Model():
         self.function_bf_soft = None
         self.outliers = exclude_outliers
         self.target_size = target_size
+        self.reader = None
         if self.bf_soft:
             self.function_bf_soft = self.get_before_softmax()
 
@@ -112,8 +114,7 @@ class TTA_Model():
             imgs = []
             # load the augmented samples
             for i in range(self.n):
-                img = load_img(self.filenames[idx * self.n + i],
-                            target_size = (self.target_size,self.target_size))
+                img = self.load_sample(self.filenames[idx * self.n + i])
                 # rescale according to parameters
                 if not type(self.mean) == type(None):
                     img = (img_to_array(img) - self.mean)/self.std
@@ -168,40 +169,70 @@ class TTA_Model():
 
         return np.exp(X)/np.sum(np.exp(X))
 
+    def load_sample(self, filename):
+        """Loads a sample from its file or from the store being read"""
+
+        if self.reader is not None:
+            return self.reader.load_img(self.reader.index_of(filename),
+                            target_size = (self.target_size,self.target_size))
+        return load_img(filename,
+                            target_size = (self.target_size,self.target_size))
+
+    def list_samples(self, filepath):
+        """Lists the classes and the samples of each class in a directory
+        or in a store packed by rhythm_shards"""
+
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if is_store(filepath):
+            self.reader = ShardReader(filepath)
+            samples = {c: [] for c in self.reader.classes}
+            for sample in self.reader.samples:
+                samples[sample['class']].append(
+                        os.path.relpath(sample['file'], sample['class']))
+            return [(c, sorted(samples[c])) for c in self.reader.classes]
+
+        listing = []
+        for subdir in sorted(os.listdir(filepath)):
+            dirpath = os.path.join(filepath, subdir)
+            # if it's a folder
+            if os.path.isdir(dirpath):
+                listing.append((subdir, sorted(os.listdir(dirpath))))
+        return listing
+
     def load_filenames(self, filepath):
 
         classes = []
         self.filenames = []
         self.ground_truth = []
         # list the classes
-        for subdir in sorted(os.listdir(filepath)):
+        for subdir, img_files in self.list_samples(filepath):
             dirpath = os.path.join(filepath, subdir)
-            # if it's a folder
-            if os.path.isdir(dirpath):
-                # save it as a class name
-                classes.append(subdir)
-                # list the samples for each class
-                for img_file in sorted(os.listdir(dirpath)):
-                    if (not os.path.join(dirpath, img_file) in self.filenames):
-                        # get the file name without extension
-                        #f, ext = os.path.splitext(img_file)
-                        # verify if it's have a pattern of an augmented image
-                        #name_pat = re.compile(r'(\w+\.*\w+\.*\w+\[.+\]\w+)(\d+)')
-                        #res = re.search(name_pat, f)
-                        # get the base name without the augmentation number
-                        #base_name, num = res.groups()
-                        name = os.path.basename(img_file)
-                        try:
-                            x = int(name[-6:-4])
-                            base_name, ext = name[:-5], name[-4:]
-                        except ValueError:
-                            x = int(name[-5])
-                            base_name, ext = name[:-6], name[-4:]
-                        # save the filenames of the augmented images found
-                        self.filenames += [os.path.join(dirpath,
-                            base_name + str(i) + ext) for i in range(self.n)]
-                        # the correspondent class is the last class listed
-                        self.ground_truth.append(classes[-1])
+            # save it as a class name
+            classes.append(subdir)
+            # list the samples for each class
+            for img_file in img_files:
+                if (not os.path.join(dirpath, img_file) in self.filenames):
+                    # get the file name without extension
+                    #f, ext = os.path.splitext(img_file)
+                    # verify if it's have a pattern of an augmented image
+                    #name_pat = re.compile(r'(\w+\.*\w+\.*\w+\[.+\]\w+)(\d+)')
+                    #res = re.search(name_pat, f)
+                    # get the base name without the augmentation number
+                    #base_name, num = res.groups()
+                    name = os.path.basename(img_file)
+                    try:
+                        x = int(name[-6:-4])
+                        base_name, ext = name[:-5], name[-4:]
+                    except ValueError:
+                        x = int(name[-5])
+                        base_name, ext = name[:-6], name[-4:]
+                    # save the filenames of the augmented images found
+                    self.filenames += [os.path.join(dirpath,
+                        base_name + str(i) + ext) for i in range(self.n)]
+                    # the correspondent class is the last class listed
+                    self.ground_truth.append(classes[-1])
         self.num_samples = len(self.filenames)
         self.num_classes = len(classes)
         # create the dictionary with the pair index-class
@@ -224,8 +255,7 @@ class TTA_Model():
                 imgs = []
                 # load the augmented samples
                 for i in range(self.n):
-                    img = load_img(self.filenames[idx * self.n + i],
-                            target_size = (self.target_size,self.target_size))
+                    img = self.load_sample(self.filenames[idx * self.n + i])
                     # rescale according to parameters
                     if not type(self.mean) == type(None):
                         img = (img_to_array(img) - self.mean)/self.std
@@ -2,15 +2,40 @@ import cv2
 import numpy as np
 import os
 import argparse
-from scipy.ndimage.filters import gaussian_filter1d
-import matplotlib.pyplot as plt
+import json
+import multiprocessing as mp
+import queue
+import threading
+import time
+import rhythm_cache
+import rhythm_kernels
+from async_writer import shared_writer, temp_name
 from math import exp
+from functools import lru_cache
+
+try:
+	import av
+except ImportError:
+	av = None
 
 DIRECTION = {
 				'H': 0,
 				'V': 1
 			}
 
+# number of frames decoded before each vectorized reduction
+BLOCK_SIZE = 128
+# upper bound in bytes of a block, so high resolution videos use less frames
+BLOCK_BYTES = 64*2**20
+# number of blocks in the ring shared by the decoding and reduction threads
+QUEUE_DEPTH = 2
+
+# columns of the rhythm mapped at once when writing it straight to disk
+MEMMAP_CHUNK = 4096
+
+# backends available to decode the videos
+BACKENDS = ['cv2', 'av']
+
 def _get_Args():
 
 	parser = argparse.ArgumentParser()
@@ -26,12 +51,26 @@ def _get_Args():
 	parser.add_argument("-db", "--database_name",
 		help= "Database name")
 	parser.add_argument("-kds", "--keep_directory_structure", help="How many levels above the file folder will be keept. If you want to keep the class folder and set folder pass 2", type=int, default=1)
+	parser.add_argument("-cf", "--config_file", help="Json file with a list of rhythm configurations to extract from a single decoding of the video. When set, mode, direction, sigma, size, percentil and color mode are taken from the file")
+	parser.add_argument("-bs", "--block_size", help="Number of frames decoded before each rhythm reduction", type=int, default=BLOCK_SIZE)
+	parser.add_argument("-qd", "--queue_depth", help="Number of blocks buffered between the decoding thread and the rhythm reduction. Use 0 to decode and reduce on a single thread", type=int, default=QUEUE_DEPTH)
+	parser.add_argument("-b", "--backend", help="Library used to decode the video. 'av' uses PyAV with codec threading and decodes gray frames directly", choices=BACKENDS, default='cv2')
+	parser.add_argument("-ns", "--segments", help="Split the video in this many temporal segments, each one decoded on its own process", type=int, default=1)
+	parser.add_argument("-fs", "--frame_stride", help="Keep one of every this many frames. The other frames are grabbed without being decoded to an image", type=int, default=1)
+	parser.add_argument("-mm", "--memmap", help="Write the rhythm to disk in chunks while the video is decoded, keeping memory usage constant. Frames are read up to the end of the video, even past the frame count of the container. Requires --ext .npy", action="store_true")
+	parser.add_argument("-cd", "--cache_dir", help="Folder of a persistent cache of rhythms. Videos whose rhythm is already there are linked from it instead of extracted")
+	parser.add_argument("-ck", "--cache_key", help="How videos are identified on the cache. 'content' hashes the file and links duplicated clips, 'stat' uses path, size and modification time", choices=['content', 'stat'], default='content')
+	parser.add_argument("-rs", "--rhythm_size", help="Area resize the frames before the reduction, so the rhythm has this many rows (the final size of the image given to the networks). Gaussian mode only resizes the axis kept on the rhythm", type=int)
+	parser.add_argument("--stats", help="Print the time spent decoding, reducing and waiting on each other", action="store_true")
 
 	args = parser.parse_args()
 
 	if args.mode == 'gaussian' and args.size is None and args.sigma is None:
 		parser.error("--mode gaussian requires --size and --sigma to be set.")
 
+	if args.memmap and (args.ext != '.npy' or args.segments > 1):
+		parser.error("--memmap requires --ext .npy and a single segment.")
+
 	return args
 
 def gaussian(size, sigma):
@@ -57,8 +96,11 @@ def alpha_img(frame, sigma, filter_size, width, height, frame_n, out):
 
 	#frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 	#transp_img = cv2.cvtColor(transp_img, cv2.COLOR_BGRA2RGBA)
-	cv2.imwrite(os.path.join(out, "transp_img{}.png".format(frame_n)), transp_img)
-	cv2.imwrite(os.path.join(out, "frame{}.png".format(frame_n)), frame)
+	# the png compression runs on the writer threads while the next frames
+	# are decoded
+	writer = shared_writer()
+	writer.save(os.path.join(out, "transp_img{}.png".format(frame_n)), transp_img)
+	writer.save(os.path.join(out, "frame{}.png".format(frame_n)), frame)
 
 def mean_rhythm(frame, direction=['H']):
 
@@ -66,45 +108,480 @@ def mean_rhythm(frame, direction=['H']):
 
 def gaussian_rhythm(frame, sigma, filter_size, width, height, direction='H', percentil=[0.5], color_mode='gray'):
 
+	# single frame version of gaussian_rhythm_block
+	return gaussian_rhythm_block(np.expand_dims(frame, axis=0), sigma,
+				filter_size, direction, percentil, color_mode)[:,0,:]
+
+def mean_rhythm_block(block, direction='H'):
+
+	# block holds n frames stacked on the first axis, so the frame axes are
+	# shifted by one. The sum is accumulated in integers and floored, which
+	# gives the same values as casting np.mean to uint8
+	ax = DIRECTION[direction] + 1
+	vr = np.sum(block, axis=ax, dtype=np.uint32)
+	vr //= block.shape[ax]
+	if vr.ndim == 2:
+		vr = np.expand_dims(vr, axis=-1)
+
+	return vr.transpose(1, 0, 2) # (rows, frames, channels)
+
+@lru_cache(maxsize=None)
+def gaussian_weights(filter_size, sigma):
+
+	# same kernel scipy.ndimage.gaussian_filter1d builds for the truncate
+	# value used by the rhythm
 	trunc = (((filter_size - 1)/2)-0.5)/sigma
+	radius = int(trunc * float(sigma) + 0.5)
+	x = np.arange(-radius, radius+1)
+	weights = np.exp(-0.5 / (sigma*sigma) * x**2)
+	weights = weights / weights.sum()
 
-	first = True
-	output = []
+	return weights[radius:] # symmetric, so keep center and right side only
 
-	out = gaussian_filter1d(frame, sigma=sigma, axis=DIRECTION[direction], truncate=trunc)
+def reflect_index(index, length):
 
-	#print("Output:\n{}".format(out))
-	#print("Output:\n{}".format(out.shape))
-	for percent in percentil:
+	# scipy's 'reflect' border mode (d c b a | a b c d | d c b a)
+	index = np.mod(index, 2*length)
+	return np.where(index < length, index, 2*length - 1 - index)
 
-		if direction == 'H':
-			vr = out[int(out.shape[0]*percent),:]
-		elif direction == 'V':
-			vr = out[:,int(out.shape[1]*percent)]
+def gaussian_windows(length, sigma, filter_size, percentil):
+
+	# weights of the filter and, for each percentile line, the rows (or
+	# columns) inside the filter window around it
+	weights = gaussian_weights(filter_size, sigma)
+	radius = len(weights) - 1
+	windows = [reflect_index(np.arange(int(length*percent) - radius,
+					int(length*percent) + radius + 1), length)
+			   for percent in percentil]
+
+	return weights, np.array(windows)
+
+def gaussian_rhythm_block(block, sigma, filter_size, direction='H',
+						  percentil=[0.5], color_mode='gray'):
+
+	# only the lines of the percentiles are filtered, as a weighted sum of
+	# the rows (or columns) inside the filter window around each line
+	ax = DIRECTION[direction] + 1
+	weights, windows = gaussian_windows(block.shape[ax], sigma, filter_size,
+										percentil)
+	radius = len(weights) - 1
+
+	output = []
+	for window in windows:
+		window = np.take(block, window, axis=ax).astype(np.float64)
+		window = np.moveaxis(window, ax, 0)
+
+		# accumulates in the same order of scipy's symmetric correlation
+		# (center first, then pairs from the outside in) and truncates the
+		# result like scipy does for integer outputs
+		vr = window[radius] * weights[0]
+		for i in range(radius, 0, -1):
+			vr += (window[radius - i] + window[radius + i]) * weights[i]
+		vr = vr.astype(np.uint8)
 
 		if color_mode == 'gray':
 			vr = np.expand_dims(vr, axis=-1)
+		output.append(vr)
 
-		if first:
-			first = False
-			output = vr
-		else:
-			output = np.concatenate((output, vr), axis=-1)
-	'''fig,axes = plt.subplots(nrows = 1, ncols = 2, figsize=(4*2,3*2))
-	axes[0].imshow(frame, cmap='gray')
-	axes[1].imshow(out, cmap='gray')
-	#axes[2].imshow(vr)
-	plt.show()'''
+	return np.concatenate(output, axis=-1).transpose(1, 0, 2)
 
-	return output
+def rhythm_block(block, mode, direction, sigma, size, percentil, color_mode,
+				 kernels=True):
 
-def videoCapture(direction, vid_file, percentil, color_mode, mode, sigma,
-				size, output, ext, db_name="database_name_here", kds=2):
+	if kernels and rhythm_kernels.USE_KERNELS and block.ndim == 4 and \
+	   (mode == 'gaussian' or direction == 'V' or color_mode == 'gray'):
+		# bgr frames go through the compiled kernels where they are faster
+		# than numpy: the gaussian rhythms, which only read the lines of the
+		# filter windows, and the mean of the rows of bgr frames. The gray
+		# conversion is done on the same pass for gray rhythms
+		gray = color_mode == 'gray'
+		if mode == 'mean':
+			return tile_mean(rhythm_kernels.mean_rhythm_block(block, direction,
+															  gray), percentil)
+		if mode == 'gaussian':
+			weights, windows = gaussian_windows(block.shape[
+							DIRECTION[direction] + 1], sigma, size, percentil)
+			return rhythm_kernels.gaussian_rhythm_block(block, weights,
+							windows, direction, gray)
 
-	direction = direction.upper()
+	if mode == 'mean':
+		return tile_mean(mean_rhythm_block(block, direction), percentil)
+	if mode == 'gaussian':
+		return gaussian_rhythm_block(block, sigma, size, direction, percentil,
+									 color_mode)
+
+def tile_mean(cols, percentil):
+
+	# the mean rhythm doesn't depend on the percentiles, but it is repeated
+	# once for each of them so it has the channels of rhythm_shape, as the
+	# gray rhythms always had
+	if len(percentil) > 1:
+		cols = np.tile(cols, (1, 1, len(percentil)))
+	return cols
+
+def rhythm_config(mode='mean', direction='H', sigma=None, size=None,
+				  percentil=[0.5], color_mode='gray'):
+
+	# configs also come from json files, so they are checked and given the
+	# types of the command line arguments, which name the output folders
+	if mode not in ('mean', 'gaussian'):
+		raise ValueError("Unknown rhythm mode {}".format(mode))
+	if color_mode not in ('gray', 'rgb', 'ic'):
+		raise ValueError("Unknown color mode {}".format(color_mode))
+	if str(direction).upper() not in DIRECTION:
+		raise ValueError("Unknown rhythm direction {}".format(direction))
+	if mode == 'gaussian' and (size is None or sigma is None):
+		raise ValueError("Gaussian rhythm requires size and sigma to be set.")
+
+	return {'mode': mode, 'direction': direction.upper(),
+			'sigma': float(sigma) if sigma is not None else None,
+			'size': float(size) if size is not None else None,
+			'percentil': [float(p) for p in percentil],
+			'color_mode': color_mode}
+
+def load_configs(config_file):
+
+	# the file holds a json list of objects with the keys of rhythm_config
+	with open(config_file, "r") as f:
+		return [rhythm_config(**config) for config in json.load(f)]
+
+def rhythm_folder_name(db_name, mode, direction, sigma, size, percentil,
+					   color_mode, stride=1, rhythm_size=None):
+
+	if mode == 'gaussian':
+		name = "{}_VR_{}_{}_Gaussian_SZ_{}_SG_{}_P_{}".format(db_name,
+		color_mode, direction, size, sigma, percentil).upper()
+	else:
+		name = "{}_VR_{}_{}_Mean_SZ_{}_SG_{}_P_{}".format(db_name,
+		color_mode, direction, size, sigma, percentil).upper()
+
+	# rhythms sampled in jumps of frames don't mix with the full ones
+	if stride > 1:
+		name += "_FS_{}".format(stride)
+	# so do the ones extracted from downscaled frames
+	if rhythm_size:
+		name += "_RS_{}".format(rhythm_size)
+
+	return name
+
+def rhythm_shape(config, width, height, length):
+
+	rows = width if config['direction'] == 'H' else height
+	channels = len(config['percentil'])
+	if config['color_mode'] != 'gray':
+		channels *= 3
+
+	return (rows, length, channels)
+
+def downscaled_size(configs, width, height, rhythm_size):
+
+	# the axis kept on the rhythm (width for H, height for V) is area resized
+	# to rhythm_size. As area resizing and the mean are both averages, a mean
+	# rhythm of the small frames is the resized rhythm of the full frames, so
+	# the reduced axis is also shrunk. The only difference is the rounding of
+	# the small frames to uint8, which moves a few values by one level.
+	# Gaussian rhythms keep the reduced axis, because the filter size and the
+	# percentile lines are given in pixels of it. The filter is linear, so
+	# resizing the other axis first is also exact up to the rounding of the
+	# small frames and the truncation of the filter output: values differ by
+	# at most one level from the area resized gaussian rhythm
+	keep_width = all(config['direction'] == 'H' or config['mode'] == 'mean'
+					 for config in configs)
+	keep_height = all(config['direction'] == 'V' or config['mode'] == 'mean'
+					  for config in configs)
+	# frames are never enlarged
+	return (min(width, rhythm_size) if keep_width else width,
+			min(height, rhythm_size) if keep_height else height)
+
+class AVCapture():
+
+	# PyAV (FFmpeg) decoder exposing the part of the cv2.VideoCapture api used
+	# here. With gray=True frames are converted to gray by FFmpeg itself, so
+	# read() returns 2d frames and cv2.cvtColor isn't needed. FFmpeg takes the
+	# luma plane, which may differ by a few gray levels from cv2's conversion
+
+	def __init__(self, filename, gray=False, threads=0):
+
+		if av is None:
+			raise ImportError('Could not import av. '
+							  'The av backend requires PyAV.')
+		self.format = 'gray' if gray else 'bgr24'
+		try:
+			self.container = av.open(filename)
+			self.stream = self.container.streams.video[0]
+			# frame and slice threading inside the codec
+			self.stream.thread_type = 'AUTO'
+			if threads:
+				self.stream.codec_context.thread_count = threads
+			self.frames = self.container.decode(self.stream)
+			self.pending = None
+		except (av.error.FFmpegError, IndexError):
+			self.container = None
+
+	def isOpened(self):
+		return self.container is not None
+
+	def get(self, prop):
+
+		stream = self.stream
+		if prop == cv2.CAP_PROP_FRAME_WIDTH:
+			return stream.codec_context.width
+		if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+			return stream.codec_context.height
+		if prop == cv2.CAP_PROP_FPS:
+			return float(stream.average_rate or 0)
+		if prop == cv2.CAP_PROP_FRAME_COUNT:
+			if stream.frames:
+				return stream.frames
+			# some containers don't store the number of frames
+			if self.container.duration and stream.average_rate:
+				return int(self.container.duration/av.time_base*
+						   stream.average_rate)
+			return 0
+		return 0
+
+	def next_frame(self):
+		if self.pending is not None:
+			frame, self.pending = self.pending, None
+			return frame
+		return next(self.frames)
+
+	def grab(self):
+		try:
+			self.next_frame()
+			return True
+		except (StopIteration, av.error.FFmpegError):
+			return False
+
+	def read(self):
+		try:
+			return True, self.next_frame().to_ndarray(format=self.format)
+		except (StopIteration, av.error.FFmpegError):
+			return False, None
+
+	def set(self, prop, value):
+
+		if prop != cv2.CAP_PROP_POS_FRAMES:
+			return False
+		stream = self.stream
+		if not stream.average_rate:
+			return False
+		# seeks to the keyframe before the frame and decodes up to it
+		frame_time = 1/(stream.average_rate*stream.time_base)
+		start = stream.start_time or 0
+		try:
+			self.container.seek(start + int(value*frame_time), stream=stream,
+								backward=True)
+			self.frames = self.container.decode(stream)
+			self.pending = None
+			for frame in self.frames:
+				if frame.pts is None:
+					return False
+				if int(round((frame.pts - start)/frame_time)) >= value:
+					self.pending = frame
+					return True
+		except av.error.FFmpegError:
+			pass
+		return False
+
+	def release(self):
+		if self.container is not None:
+			self.container.close()
+
+def open_video(vid_file, backend='cv2', gray=False):
+
+	if backend == 'av':
+		return AVCapture(vid_file, gray)
+	return cv2.VideoCapture(vid_file)
+
+class MemmapRhythm():
+
+	# rhythm written to disk while it is extracted. Columns are appended to a
+	# frame major spill file that grows one chunk at a time, and only the
+	# chunk being written is mapped. finalize() transposes the spill file
+	# into the .npy files chunk by chunk, truncated to the columns written
+
+	def __init__(self, filenames, rows, channels, chunk=MEMMAP_CHUNK):
+
+		self.filenames = filenames
+		self.spill = filenames[0] + ".part"
+		self.rows = rows
+		self.channels = channels
+		self.chunk = chunk
+		self.length = 0
+		self.window = None # (first column, memmap) of the mapped chunk
+		open(self.spill, 'wb').close()
+
+	def map_chunk(self, first):
+
+		column = self.rows*self.channels
+		self.window = None # flushes and unmaps the previous chunk
+		with open(self.spill, 'r+b') as f:
+			f.truncate((first + self.chunk)*column)
+		self.window = (first, np.memmap(self.spill, dtype=np.uint8,
+							mode='r+', offset=first*column,
+							shape=(self.chunk, self.rows, self.channels)))
+
+	def append(self, cols):
+
+		# cols is a (rows, frames, channels) slab
+		written = 0
+		while written < cols.shape[1]:
+			if self.window is None or \
+			   self.length >= self.window[0] + self.chunk:
+				self.map_chunk(self.length)
+			first, data = self.window
+			n = min(cols.shape[1] - written, first + self.chunk - self.length)
+			data[self.length - first:self.length - first + n] = \
+				cols[:,written:written+n].transpose(1, 0, 2)
+			self.length += n
+			written += n
+
+	def finalize(self):
+
+		self.window = None
+		column = self.rows*self.channels
+		split = len(self.filenames) > 1 # one file for each channel
+		# written on temporary names and renamed at the end, as the outputs
+		# may be hard links of the rhythm cache that must not be rewritten
+		temps = [temp_name(filename) for filename in self.filenames]
+		for i, filename in enumerate(temps):
+			shape = (self.rows, self.length) if split else \
+					(self.rows, self.length, self.channels)
+			out = np.lib.format.open_memmap(filename, mode='w+',
+											dtype=np.uint8, shape=shape)
+			del out
+
+		for first in range(0, self.length, self.chunk):
+			n = min(self.chunk, self.length - first)
+			data = np.memmap(self.spill, dtype=np.uint8, mode='r',
+							 offset=first*column,
+							 shape=(n, self.rows, self.channels))
+			for i, filename in enumerate(temps):
+				out = np.load(filename, mmap_mode='r+')
+				if split:
+					out[:,first:first+n] = data[:,:,i].T
+				else:
+					out[:,first:first+n] = data.transpose(1, 0, 2)
+				out.flush()
+				del out
+			del data
+
+		os.remove(self.spill)
+		for tmp, filename in zip(temps, self.filenames):
+			os.replace(tmp, filename)
+		return [np.load(filename, mmap_mode='r')
+				for filename in self.filenames]
+
+def new_stats():
+
+	# seconds spent on each stage of the extraction. wait_decode is the time
+	# the reduction waited for decoded frames and wait_compute the time the
+	# decoding waited for a free buffer
+	return {'frames': 0, 'invalid': 0, 'decode': 0.0, 'compute': 0.0,
+			'wait_decode': 0.0, 'wait_compute': 0.0}
+
+def new_block(block_size, width, height, need_gray, need_bgr, size=None):
+
+	# size is the (width, height) frames are resized to before being stored
+	return {'size': size,
+			'gray': np.empty((block_size, height, width), dtype=np.uint8)
+					if need_gray else None,
+			'bgr': np.empty((block_size, height, width, 3), dtype=np.uint8)
+					if need_bgr else None,
+			'filled': 0, 'eof': False}
+
+def kept_frames(start, stop, stride=1):
+
+	# frames at positions multiple of stride are kept
+	return max(-(-stop//stride) - -(-start//stride), 0)
+
+def fill_block(vid, block, position, stop, length, vid_file, stride=1):
+
+	block['filled'] = filled = 0
+	block_size = len(block['gray'] if block['gray'] is not None
+					 else block['bgr'])
+	invalid_frames = 0
+	while filled < block_size and position < stop:
+		if position % stride:
+			# skipped frames are only grabbed, never retrieved and converted
+			vid.grab()
+			position += 1
+			continue
+		# read frame from video
+		(flag, frame) = vid.read()
+		position += 1
+		if not flag and position > length:
+			# the container had more frames than it told, and now it ended
+			block['eof'] = True
+			break
+		if not flag: # check if frame is valid (readed correctly)
+			print("Invalid frame at position {} of {} on video {}".format(position,length,vid_file))
+			invalid_frames += 1
+			continue
+		if block['size'] is not None and frame.shape[1::-1] != block['size']:
+			# resized before the gray conversion, which then has less pixels
+			frame = cv2.resize(frame, block['size'],
+							   interpolation=cv2.INTER_AREA)
+		if frame.ndim == 2:
+			block['gray'][filled] = frame # decoded as gray by the backend
+		elif block['gray'] is not None:
+			cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=block['gray'][filled]) # convert to grayscale
+		if block['bgr'] is not None:
+			# cv2 already loads and save image in default bgr mode
+			# no convertions needed
+			block['bgr'][filled] = frame
+		filled += 1
+
+	block['filled'] = filled
+	return position, invalid_frames
+
+def decode_worker(vid, free, full, position, stop, length, vid_file, stride,
+				  stats, halt):
+
+	# producer side of the pipeline, fills the free buffers of the ring
+	try:
+		while position < stop:
+			start = time.perf_counter()
+			block = free.get()
+			stats['wait_compute'] += time.perf_counter() - start
+			if halt.is_set():
+				return
+
+			start = time.perf_counter()
+			position, invalid_frames = fill_block(vid, block, position, stop,
+												  length, vid_file, stride)
+			stats['decode'] += time.perf_counter() - start
+			stats['invalid'] += invalid_frames
+			full.put(block)
+			if block['eof']:
+				break
+		full.put(None)
+	except Exception as e:
+		full.put(e)
+
+def seek_frame(vid, position):
+
+	# seeks are frame accurate on both backends, but some broken containers
+	# refuse them, so it falls back to reading up to the position
+	if position == 0 or vid.set(cv2.CAP_PROP_POS_FRAMES, position):
+		return
+	for _ in range(position):
+		vid.grab()
+
+def extract_range(vid_file, configs, start_frame=0, stop_frame=None,
+				  block_size=BLOCK_SIZE, queue_depth=QUEUE_DEPTH, stats=None,
+				  backend='cv2', stride=1, memmap_files=None, rhythm_size=None):
+
+	stats = new_stats() if stats is None else stats
+
+	# frames are decoded only once into reusable blocks (one for each color
+	# mode needed) and every block is reduced for all the configurations
+	need_gray = any(config['color_mode'] == 'gray' for config in configs)
+	need_bgr = any(config['color_mode'] != 'gray' for config in configs)
 
 	# capture video passing video filename
-	vid = cv2.VideoCapture(vid_file)
+	vid = open_video(vid_file, backend, gray=not need_bgr)
 
 	# verifies if it have initialized the capture
 	if(not vid.isOpened()): return None
@@ -113,57 +590,183 @@ def videoCapture(direction, vid_file, percentil, color_mode, mode, sigma,
 	width = int(vid.get(cv2.CAP_PROP_FRAME_WIDTH))
 	height = int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
 	length = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
-	fps = float(vid.get(cv2.CAP_PROP_FPS))
-	'''print ("video: {}".format(vid_file))
-	print ("video resolution: {} x {}".format(width, height))
-	print ("number of frames: {}".format(length))
-	print ("frame rate: {:.2f}".format(fps))'''
 
-	if direction == 'H':
-		vr = np.zeros((width,length, len(percentil)
-			if color_mode == 'gray' else len(percentil)*3),
-			dtype=np.uint8)
+	size = None
+	if rhythm_size:
+		size = downscaled_size(configs, width, height, rhythm_size)
+		width, height = size
+
+	# broken containers report no frames, then the columns are gathered
+	# until the video ends instead of written on preallocated rhythms
+	unknown = length <= 0 and not memmap_files
+	if memmap_files or unknown:
+		# the frame count of the container isn't trusted, the video is read
+		# until it ends
+		stop_frame = float('inf') if stop_frame is None else stop_frame
+	if memmap_files:
+		rhythms = [MemmapRhythm(files, *rhythm_shape(config, width, height,
+					0)[::2]) for config, files in zip(configs, memmap_files)]
+	elif unknown:
+		rhythms = [[] for config in configs]
+	else:
+		stop_frame = length if stop_frame is None else min(stop_frame, length)
+		rhythms = [np.zeros(rhythm_shape(config, width, height,
+					kept_frames(start_frame, stop_frame, stride)),
+					dtype=np.uint8) for config in configs]
+	seek_frame(vid, start_frame)
+
+	# with numba the gray conversion of gaussian rhythms is fused into the
+	# reduction, so only the lines of the filter windows are converted and
+	# bgr frames are stored instead of gray ones. Mean rhythms still use
+	# cv2.cvtColor, which is faster than converting inside the kernel. Only
+	# when the backend decodes bgr frames anyway and the range is long enough
+	# to pay back the import of numba
+	kernels = rhythm_kernels.worth_it(width*height*(min(stop_frame, length) -
+									  start_frame)//stride)
+	fuse_gray = need_gray and kernels and \
+				(backend == 'cv2' or need_bgr) and \
+				all(config['mode'] == 'gaussian' for config in configs
+					if config['color_mode'] == 'gray')
+	if fuse_gray:
+		need_gray, need_bgr = False, True
+
+	frame_bytes = height*width*(need_gray + 3*need_bgr)
+	block_size = max(1, min(block_size, BLOCK_BYTES//max(frame_bytes, 1)))
+
+	done = 0 # columns already written in the rhythms
+	def reduce_block(block):
+		nonlocal done
+		start = time.perf_counter()
+		filled = block['filled']
+		for config, vr in zip(configs, rhythms):
+			frames = block['gray' if config['color_mode'] == 'gray' and
+						   not fuse_gray else 'bgr']
+			# setting visual rhythm for the frames of the block
+			cols = rhythm_block(frames[:filled], config['mode'],
+							config['direction'], config['sigma'],
+							config['size'], config['percentil'],
+							config['color_mode'], kernels)
+			if memmap_files:
+				vr.append(cols)
+			elif unknown:
+				# copied, the columns may be a view of the reused block
+				vr.append(cols.copy())
+			else:
+				vr[:,done:done+filled,:] = cols
+		done += filled
+		stats['compute'] += time.perf_counter() - start
+
+	if queue_depth < 1:
+		block = new_block(block_size, width, height, need_gray, need_bgr,
+						  size)
+		position = start_frame
+		while position < stop_frame and not block['eof']:
+			start = time.perf_counter()
+			position, invalid_frames = fill_block(vid, block, position,
+										stop_frame, length, vid_file, stride)
+			stats['decode'] += time.perf_counter() - start
+			stats['invalid'] += invalid_frames
+			reduce_block(block)
+	else:
+		# a decoding thread fills a ring of queue_depth blocks while this one
+		# reduces them. OpenCV releases the GIL when decoding the frames
+		free = queue.Queue()
+		full = queue.Queue()
+		for _ in range(queue_depth):
+			free.put(new_block(block_size, width, height, need_gray, need_bgr,
+							   size))
+		halt = threading.Event()
+		decoder = threading.Thread(target=decode_worker, daemon=True,
+					args=(vid, free, full, start_frame, stop_frame, length,
+						  vid_file, stride, stats, halt))
+		decoder.start()
+		try:
+			while True:
+				start = time.perf_counter()
+				block = full.get()
+				stats['wait_decode'] += time.perf_counter() - start
+				if block is None:
+					break
+				if isinstance(block, Exception):
+					raise block
+				reduce_block(block)
+				free.put(block)
+		finally:
+			# unblocks the decoding thread if the reduction has failed
+			halt.set()
+			free.put(None)
+			decoder.join()
+
+	vid.release()
+	stats['frames'] += done
+
+	if memmap_files:
+		# for each configuration, the read only memmaps of its files
+		return [vr.finalize() for vr in rhythms]
+
+	if unknown:
+		return [np.concatenate(vr, axis=1) if vr else
+				np.zeros(rhythm_shape(config, width, height, 0), dtype=np.uint8)
+				for config, vr in zip(configs, rhythms)]
 
-	elif direction == 'V':
-		vr = np.zeros((height,length, len(percentil)
-			if color_mode == 'gray' else len(percentil)*3),
-			dtype=np.uint8)
+	# slices only valid frames
+	return [vr[:,:done] for vr in rhythms]
 
+def extract_segment(task):
 
-	invalid_frames = 0
-	for i in range(length):
-	# read frame from video
-		(flag, frame) = vid.read()
-		if not flag: # check if frame is valid (readed correctly)
-			print("Invalid frame at position {} of {} on video {}".format(i+1,length,vid_file))
-			invalid_frames += 1
-			continue
-		if color_mode == 'gray':
-			frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) # convert to grayscale
-		else:
-			# cv2 already loads and save image in default bgr mode
-			# no convertions needed
-			#frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) # convert to RGB
-			pass
+	# runs on the worker processes, returns the stats to be merged
+	(vid_file, configs, start, stop, block_size, queue_depth, backend,
+	 stride, rhythm_size) = task
+	stats = new_stats()
+	rhythms = extract_range(vid_file, configs, start, stop, block_size,
+							queue_depth, stats, backend, stride, None,
+							rhythm_size)
+	return rhythms, stats
 
-		if mode == 'mean':
-			vr[:,i-invalid_frames,:] = mean_rhythm(frame, direction) # setting visual rhythm for frame i
-		if mode == 'gaussian':
-			vr[:,i-invalid_frames,:] = gaussian_rhythm(frame, sigma, size, width, height, direction, percentil, color_mode) # setting visual rhythm for frame i
-		if mode == "transp":
-			alpha_img(frame, sigma, size, width, height, i, output)
+def extract_rhythms(vid_file, configs, block_size=BLOCK_SIZE,
+					queue_depth=QUEUE_DEPTH, stats=None, backend='cv2',
+					segments=1, stride=1, memmap_files=None, rhythm_size=None):
 
-	# slices only valid frames
-	vr = vr[:,:length - invalid_frames]
+	stats = new_stats() if stats is None else stats
 
-	if mode == 'gaussian':
-		rhythm_dir =  os.path.join(
-		"{}_VR_{}_{}_Gaussian_SZ_{}_SG_{}_P_{}".format(db_name, color_mode,
-		direction, size, sigma, percentil).upper())
-	else:
-		rhythm_dir =  os.path.join(
-		"{}_VR_{}_{}_Mean_SZ_{}_SG_{}_P_{}".format(db_name, color_mode,
-		direction, size, sigma, percentil).upper())
+	if segments <= 1 or memmap_files:
+		return extract_range(vid_file, configs, 0, None, block_size,
+							 queue_depth, stats, backend, stride, memmap_files,
+							 rhythm_size)
+
+	vid = open_video(vid_file, backend)
+	if(not vid.isOpened()): return None
+	length = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+	vid.release()
+	if length <= 0:
+		# broken containers don't report their frames, so the segments can't
+		# be placed and the video is read in a single pass
+		return extract_range(vid_file, configs, 0, None, block_size,
+							 queue_depth, stats, backend, stride, None,
+							 rhythm_size)
+
+	# each process seeks to the first frame of its segment and the rhythm
+	# columns of the segments are joined back in order. Invalid frames are
+	# dropped inside each segment, so the joined rhythm is the same of a
+	# single pass
+	bounds = np.linspace(0, length, segments + 1).astype(int)
+	tasks = [(vid_file, configs, start, stop, block_size, queue_depth, backend,
+			  stride, rhythm_size) for start, stop in zip(bounds[:-1], bounds[1:])
+			 if stop > start]
+	# more segments than cores are queued on the pool
+	with mp.Pool(processes=min(len(tasks), os.cpu_count())) as pool:
+		results = pool.map(extract_segment, tasks)
+
+	parts = []
+	for rhythms, segment_stats in results:
+		if rhythms is None: return None
+		parts.append(rhythms)
+		for key in stats:
+			stats[key] += segment_stats[key]
+
+	return [np.concatenate(rhythms, axis=1) for rhythms in zip(*parts)]
+
+def rhythm_files(vid_file, output, rhythm_dir, ext, color_mode, kds):
 
 	# get directory and and get the last subidr of directory
 	temp, _class = os.path.split(os.path.dirname(vid_file))
@@ -185,27 +788,145 @@ def videoCapture(direction, vid_file, percentil, color_mode, mode, sigma,
 	'''
 	filename = os.path.splitext(os.path.basename(vid_file))[0] + "{}".format(ext)
 
+	# ic mode saves each channel on its own folder
 	if color_mode == "ic":
-		temp = 'RGB'
-		for i in range(3):
-			temp_out = os.path.join(outdir, temp[i])
+		files = []
+		for channel in 'RGB':
+			temp_out = os.path.join(outdir, channel)
 			os.makedirs(temp_out, exist_ok=True)
-			temp_name = os.path.join(temp_out, filename)
-			if ext == ".npy":
-				np.save(temp_name, vr[:,:,i])
-			else:
-				cv2.imwrite(temp_name, vr[:,:,i])
+			files.append(os.path.join(temp_out, filename))
+		return files
+
+	return [os.path.join(outdir, filename)]
+
+def save_rhythm(vr, vid_file, output, rhythm_dir, ext, color_mode, kds):
+
+	files = rhythm_files(vid_file, output, rhythm_dir, ext, color_mode, kds)
+	writer = shared_writer()
+	for i, filename in enumerate(files):
+		img = vr[:,:,i] if len(files) > 1 else vr
+		writer.save(filename, img)
+
+def transp_capture(vid_file, color_mode, sigma, size, output):
+
+	vid = cv2.VideoCapture(vid_file)
+	if(not vid.isOpened()): return None
+
+	width = int(vid.get(cv2.CAP_PROP_FRAME_WIDTH))
+	height = int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+	length = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+
+	invalid_frames = 0
+	for i in range(length):
+		(flag, frame) = vid.read()
+		if not flag:
+			print("Invalid frame at position {} of {} on video {}".format(i+1,length,vid_file))
+			invalid_frames += 1
+			continue
+		if color_mode == 'gray':
+			frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+		alpha_img(frame, sigma, size, width, height, i, output)
+
+	return width, height, length - invalid_frames
+
+def videoCapture(direction, vid_file, percentil, color_mode, mode, sigma,
+				size, output, ext, db_name="database_name_here", kds=2,
+				block_size=BLOCK_SIZE, queue_depth=QUEUE_DEPTH, stats=None,
+				backend='cv2', segments=1, stride=1, memmap=False,
+				cache_dir=None, cache_key='content', rhythm_size=None):
+
+	direction = direction.upper()
+	rhythm_dir = rhythm_folder_name(db_name, mode, direction, sigma, size,
+									percentil, color_mode, stride, rhythm_size)
+
+	if mode == "transp":
+		info = transp_capture(vid_file, color_mode, sigma, size, output)
+		if info is None: return None
+		width, height, length = info
+		# transp mode only writes the debug images, the rhythm stays empty.
+		# Its shape is the one of any other rhythm
+		config = rhythm_config('mean', direction, percentil=percentil,
+							   color_mode=color_mode)
+		vr = np.zeros(rhythm_shape(config, width, height, length),
+					  dtype=np.uint8)
 	else:
-		filename = os.path.join(outdir, filename)
-		if ext == ".npy":
-			np.save(filename, vr)
-		else:
-			cv2.imwrite(filename, vr)
+		config = rhythm_config(mode, direction, sigma, size, percentil,
+							   color_mode)
+		return videoCaptureMulti(vid_file, [config], output, ext, db_name,
+					kds, block_size, queue_depth, stats, backend, segments,
+					stride, memmap, cache_dir, cache_key, rhythm_size)
+
+	save_rhythm(vr, vid_file, output, rhythm_dir, ext, color_mode, kds)
+
+def videoCaptureMulti(vid_file, configs, output, ext,
+					  db_name="database_name_here", kds=2,
+					  block_size=BLOCK_SIZE, queue_depth=QUEUE_DEPTH,
+					  stats=None, backend='cv2', segments=1, stride=1,
+					  memmap=False, cache_dir=None, cache_key='content',
+					  rhythm_size=None):
+
+	rhythm_dirs = [rhythm_folder_name(db_name, config['mode'],
+						config['direction'], config['sigma'], config['size'],
+						config['percentil'], config['color_mode'], stride,
+						rhythm_size)
+				   for config in configs]
+	files = [rhythm_files(vid_file, output, rhythm_dir, ext,
+			 config['color_mode'], kds) for config, rhythm_dir in
+			 zip(configs, rhythm_dirs)]
+
+	missing = list(range(len(configs)))
+	if cache_dir:
+		try:
+			vid_key = rhythm_cache.video_key(vid_file, cache_dir, cache_key)
+		except OSError:
+			return None
+		# everything that changes the content of the rhythm files
+		params = {'ext': ext, 'backend': backend, 'stride': stride}
+		if rhythm_size:
+			# only set when used, keeping the keys of full size rhythms
+			params['rhythm_size'] = rhythm_size
+		keys = [rhythm_cache.rhythm_key(vid_key, {'config': config, **params})
+				for config in configs]
+		missing = [i for i in missing
+				   if not rhythm_cache.fetch(cache_dir, keys[i], files[i])]
+		if not missing: return None
+
+	# decodes the video once and writes every configuration on its own folder
+	rhythms = extract_rhythms(vid_file, [configs[i] for i in missing],
+				block_size, queue_depth, stats, backend, segments, stride,
+				[files[i] for i in missing] if memmap else None, rhythm_size)
+	if rhythms is None: return None
+
+	for i, vr in zip(missing, rhythms):
+		# with memmap the rhythm was written to its files during extraction
+		if not memmap:
+			save_rhythm(vr, vid_file, output, rhythm_dirs[i], ext,
+						configs[i]['color_mode'], kds)
+	if cache_dir:
+		# the files are linked into the cache only when completely written
+		shared_writer().flush()
+		for i in missing:
+			rhythm_cache.store(cache_dir, keys[i], files[i])
 
 def _main(args):
-	videoCapture(args.direction, args.input, args.percentil, args.color_mode,
-				args.mode, args.sigma, args.size, args.output, args.ext,
-				args.database_name, args.keep_directory_structure)
+	stats = new_stats()
+	if args.config_file:
+		videoCaptureMulti(args.input, load_configs(args.config_file),
+				args.output, args.ext, args.database_name,
+				args.keep_directory_structure, args.block_size,
+				args.queue_depth, stats, args.backend, args.segments,
+				args.frame_stride, args.memmap, args.cache_dir, args.cache_key,
+				args.rhythm_size)
+	else:
+		videoCapture(args.direction, args.input, args.percentil,
+				args.color_mode, args.mode, args.sigma, args.size, args.output,
+				args.ext, args.database_name, args.keep_directory_structure,
+				args.block_size, args.queue_depth, stats, args.backend,
+				args.segments, args.frame_stride, args.memmap, args.cache_dir,
+				args.cache_key, args.rhythm_size)
+	shared_writer().flush()
+	if args.stats:
+		print(json.dumps(stats, sort_keys=True))
 
 if __name__ == '__main__':
 	# parse arguments
@@ -14,6 +14,7 @@ from keras import __version__ as keras_version
 from simpleModel import get_dirs, formatTime, plot_and_save, print_best_acc, handle_opt_params, model_from_config
 from automatize_helper import save_infos
 from TTA_Model import TTA_Model
+from rhythm_shards import flow_from, count_samples, list_classes
 
 # python imports
 import os
@@ -289,10 +290,11 @@ def get_img_fit_flow(image_config, fit_sample_size, flow_dir_config):
 	Args:
 		image_config (dict): Holds the vars for data augmentation
 		fit_sample_size (float): Subunit multiplier to get the sample size for normalization
-		flow_dir_config (dict): Holds the vars for flow_from_directory
+		flow_dir_config (dict): Holds the vars for flow_from_directory. The
+					directory can also be a store packed by rhythm_shards
 
 	Returns:
-		A `DirectoryIterator` yielding tuples of `(x, y)`
+		A `DirectoryIterator` (or `ShardIterator`) yielding tuples of `(x, y)`
 					where `x` is a numpy array containing a batch
 					of images with shape `(batch_size, *target_size, channels)`
 					and `y` is a numpy array of corresponding labels.
@@ -309,7 +311,7 @@ def get_img_fit_flow(image_config, fit_sample_size, flow_dir_config):
 		count_samples = 1
 
 		img_gen = ImageDataGenerator()
-		batches = img_gen.flow_from_directory(**flow_dir_config)
+		batches = flow_from(img_gen, **flow_dir_config)
 
 		batch_size = flow_dir_config['batch_size'] if 'batch_size' in flow_dir_config else 16
 
@@ -323,7 +325,7 @@ def get_img_fit_flow(image_config, fit_sample_size, flow_dir_config):
 		except Exception as e:
 			print("mean and stdev not found: {}".format(e))
 
-			for i in trange(batches.samples//batch_size), desc='Taking mean and standard deviation'):
+			for i in trange(batches.samples//batch_size, desc='Taking mean and standard deviation'):
 			#for i in range(batches.samples//batch_size):
 				imgs, labels = next(batches)
 				idx = np.random.choice(imgs.shape[0], int(batch_size*fit_sample_size),
@@ -342,7 +344,7 @@ def get_img_fit_flow(image_config, fit_sample_size, flow_dir_config):
 		new_img_gen.mean = mean
 
 	# unpack the necessary ones
-	return new_img_gen.flow_from_directory(**flow_dir_config), stdev, mean
+	return flow_from(new_img_gen, **flow_dir_config), stdev, mean
 
 def load_dataset(bs, indir, net_model, center = True,
 					std_norm = True, data_aug = {}):
@@ -354,11 +356,12 @@ def load_dataset(bs, indir, net_model, center = True,
 	# loading dataset and getting the samples amount of each set
 	dir_train, dir_valid, dir_test = get_dirs(indir)
 
-	num_classes = len(os.listdir(dir_train))
+	# each set may also be a store packed by rhythm_shards
+	num_classes = len(list_classes(dir_train))
 
-	num_train = sum([len(files) for r, d, files in os.walk(dir_train)])
-	num_test = sum([len(files) for r, d, files in os.walk(dir_test)])
-	num_valid = sum([len(files) for r, d, files in os.walk(dir_valid)])
+	num_train = count_samples(dir_train)
+	num_test = count_samples(dir_test)
+	num_valid = count_samples(dir_valid)
 
 	# retrieving the image size according to network
 	img_size = get_img_size(net_model)
@@ -373,7 +376,7 @@ def load_dataset(bs, indir, net_model, center = True,
 	else:
 		data_aug['rescale'] = 1./255
 		train_datagen = ImageDataGenerator(**data_aug)
-		train_gen = train_datagen.flow_from_directory(dir_train,
+		train_gen = flow_from(train_datagen, dir_train,
 					target_size = (img_size, img_size), batch_size = bs,
 					class_mode = 'categorical')
 
@@ -388,7 +391,7 @@ def load_dataset(bs, indir, net_model, center = True,
 		else:
 			valid_datagen = ImageDataGenerator(rescale=1./255)
 
-		valid_gen = valid_datagen.flow_from_directory(dir_valid,
+		valid_gen = flow_from(valid_datagen, dir_valid,
 					target_size = (img_size, img_size), batch_size = bs,
 					class_mode = 'categorical')
 	except:
@@ -404,7 +407,7 @@ def load_dataset(bs, indir, net_model, center = True,
 		else:
 			test_datagen = ImageDataGenerator(rescale=1./255)
 
-		test_gen = test_datagen.flow_from_directory(dir_test,
+		test_gen = flow_from(test_datagen, dir_test,
 					target_size = (img_size, img_size), batch_size = bs,
 					class_mode = 'categorical')
 
@@ -0,0 +1,132 @@
+import os
+import atexit
+import threading
+import numpy as np
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+# threads encoding and writing files
+WRITE_WORKERS = 4
+# files waiting to be written before save() blocks the caller
+WRITE_DEPTH = 16
+
+class AsyncWriter():
+
+	# encodes and writes images and arrays on a pool of threads, so the
+	# compression of the outputs overlaps with the decoding of the next frames.
+	# cv2.imencode and the file writes release the GIL. At most depth files
+	# are pending, the caller blocks on save() when the writer falls behind.
+	# Arrays are written as they are when encoded, so they must not be
+	# changed after being passed to save()
+
+	def __init__(self, workers=WRITE_WORKERS, depth=WRITE_DEPTH):
+
+		self.pool = ThreadPoolExecutor(max_workers=workers)
+		self.slots = threading.BoundedSemaphore(depth)
+		self.pending = set()
+		self.lock = threading.Lock()
+		self.error = None
+
+	def save(self, filename, data, params=None):
+
+		# data is a numpy array (saved with np.save for .npy files and
+		# encoded by OpenCV in the format of the extension otherwise) or a
+		# PIL image, saved by PIL itself
+		self.raise_error()
+		self.slots.acquire()
+		try:
+			future = self.pool.submit(self.write, filename, data, params)
+		except BaseException:
+			self.slots.release()
+			raise
+		with self.lock:
+			self.pending.add(future)
+		future.add_done_callback(self.done)
+		return future
+
+	def write(self, filename, data, params=None):
+
+		if not isinstance(data, np.ndarray):
+			replace_file(filename, data.save)
+			return
+		if os.path.splitext(filename)[1] == '.npy':
+			replace_file(filename, lambda tmp: np.save(tmp, data))
+			return
+		flag, buf = cv2.imencode(os.path.splitext(filename)[1], data,
+								 params or [])
+		if not flag:
+			raise IOError("Unable to encode {}".format(filename))
+		def write_buffer(tmp):
+			with open(tmp, "wb") as f:
+				f.write(buf)
+		replace_file(filename, write_buffer)
+
+	def done(self, future):
+
+		with self.lock:
+			self.pending.discard(future)
+			if future.exception() is not None and self.error is None:
+				self.error = future.exception()
+		self.slots.release()
+
+	def raise_error(self):
+
+		# failures of the threads are raised on the next call of the caller
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise error
+
+	def flush(self):
+
+		# waits for every file saved so far
+		with self.lock:
+			pending = list(self.pending)
+		for future in pending:
+			future.exception()
+		self.raise_error()
+
+	def close(self):
+
+		self.pool.shutdown(wait=True)
+		self.raise_error()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+def temp_name(filename):
+
+	# name a file is written on before being renamed to filename. It keeps
+	# the extension, which np.save, OpenCV and PIL look at
+	base, ext = os.path.splitext(filename)
+	return "{}.{}.{}.tmp{}".format(base, os.getpid(), threading.get_ident(),
+								   ext)
+
+def replace_file(filename, write):
+
+	# write(name) creates the file on a temporary name, renamed over filename
+	# at once. Outputs may be hard links of the rhythm cache, which must never
+	# be truncated and rewritten in place
+	tmp = temp_name(filename)
+	try:
+		write(tmp)
+		os.replace(tmp, filename)
+	except BaseException:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+
+shared = None
+shared_lock = threading.Lock()
+
+def shared_writer():
+
+	# writer used by all the scripts of a process, flushed when it exits
+	global shared
+	with shared_lock:
+		if shared is None:
+			shared = AsyncWriter()
+			atexit.register(shared.close)
+		return shared
@@ -0,0 +1,185 @@
+import cv2
+import numpy as np
+import os
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import platform
+import resource
+import shutil
+import sys
+import time
+
+import VideoCapture
+from async_writer import shared_writer
+
+def _get_Args():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-o", "--output", help="Json file with the results. They are printed when not set")
+	parser.add_argument("-wd", "--work_dir", help="Folder of the synthetic videos and of the extracted rhythms", default="benchmark_dir")
+	parser.add_argument("-r", "--resolution", help="Width and height of the synthetic video", type=int, nargs=2, default=[1280, 720])
+	parser.add_argument("-l", "--length", help="Number of frames of the synthetic video", type=int, default=300)
+	parser.add_argument("-fps", "--fps", help="Frame rate of the synthetic video", type=float, default=25.0)
+	parser.add_argument("-fc", "--fourcc", help="Codec of the synthetic video", default="MJPG")
+	parser.add_argument("-ve", "--video_ext", help="Container of the synthetic video", default=".avi")
+	parser.add_argument("-m", "--modes", help="Capture modes", nargs='+', choices=['mean', 'gaussian'], default=['mean', 'gaussian'])
+	parser.add_argument("-d", "--directions", help="Visual rhythm directions", nargs='+', choices=['H', 'V'], default=['H', 'V'])
+	parser.add_argument("-c", "--color_modes", help="Color modes", nargs='+', choices=['gray', 'rgb', 'ic'], default=['gray', 'rgb', 'ic'])
+	parser.add_argument("-p", "--percentiles", help="Number of percentile lines of the gaussian rhythms, evenly spaced on the frame", type=int, nargs='+', default=[1, 3])
+	parser.add_argument("-sg", "--sigma", type=float, help="Standard deviation of the gaussian filter", default=5.0)
+	parser.add_argument("-s", "--size", type=float, help="Gaussian filter size", default=11.0)
+	parser.add_argument("-e", "--ext", help="Extension of the rhythms", default=".npy")
+	parser.add_argument("-n", "--repeat", help="Runs of each case, the fastest one is reported", type=int, default=3)
+	parser.add_argument("-bs", "--block_size", type=int, default=VideoCapture.BLOCK_SIZE)
+	parser.add_argument("-qd", "--queue_depth", type=int, default=VideoCapture.QUEUE_DEPTH)
+	parser.add_argument("-b", "--backend", choices=VideoCapture.BACKENDS, default='cv2')
+	parser.add_argument("-ns", "--segments", type=int, default=1)
+	parser.add_argument("-fs", "--frame_stride", type=int, default=1)
+	parser.add_argument("-rs", "--rhythm_size", type=int)
+
+	return parser.parse_args()
+
+def synthetic_video(filename, width, height, length, fps=25.0, fourcc='MJPG'):
+
+	# moving gradients and a bouncing square, so the codec has motion and
+	# texture to encode like on real clips. The frames only depend on the
+	# parameters, so the video is reused when it already exists
+	if os.path.isfile(filename):
+		return filename
+	os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+	writer = cv2.VideoWriter(filename + ".tmp" + os.path.splitext(filename)[1],
+							 cv2.VideoWriter_fourcc(*fourcc), fps,
+							 (width, height))
+	if not writer.isOpened():
+		raise IOError("Unable to write a {} video with codec {}".format(
+					  os.path.splitext(filename)[1], fourcc))
+
+	x = np.arange(width, dtype=np.float32)
+	y = np.arange(height, dtype=np.float32)[:, None]
+	side = max(min(width, height)//5, 1)
+	frame = np.empty((height, width, 3), dtype=np.uint8)
+	for i in range(length):
+		frame[:,:,0] = (x + 4*i) % 256
+		frame[:,:,1] = (y + 2*i) % 256
+		frame[:,:,2] = ((x + y)/2 - 3*i) % 256
+		left = abs((7*i) % (2*(width - side)) - (width - side))
+		top = abs((5*i) % (2*(height - side)) - (height - side))
+		frame[top:top+side, left:left+side] = 255 - frame[top:top+side,
+														  left:left+side]
+		writer.write(frame)
+	writer.release()
+	os.replace(filename + ".tmp" + os.path.splitext(filename)[1], filename)
+
+	return filename
+
+def benchmark_cases(args):
+
+	cases = []
+	for mode, direction, color_mode, count in itertools.product(args.modes,
+						args.directions, args.color_modes, args.percentiles):
+		# the mean rhythm doesn't use the percentiles
+		if mode == 'mean' and count != args.percentiles[0]:
+			continue
+		percentil = [float(round(p, 4)) for p in
+					 np.linspace(0, 1, count + 2)[1:-1]] if mode == 'gaussian' \
+					else [0.5]
+		cases.append({'mode': mode, 'direction': direction,
+					  'color_mode': color_mode, 'percentil': percentil})
+	return cases
+
+def run_case(vid_file, case, args, output, conn):
+
+	# runs on a child process, so the peak memory is only the one of the case
+	try:
+		stats = VideoCapture.new_stats()
+		start = time.perf_counter()
+		VideoCapture.videoCapture(case['direction'], vid_file,
+					case['percentil'], case['color_mode'], case['mode'],
+					args.sigma, args.size, output, args.ext, "benchmark", 1,
+					args.block_size, args.queue_depth, stats, args.backend,
+					args.segments, args.frame_stride,
+					rhythm_size=args.rhythm_size)
+		shared_writer().flush()
+		stats['total'] = time.perf_counter() - start
+		# kilobytes on Linux
+		stats['peak_rss_mb'] = resource.getrusage(
+							   resource.RUSAGE_SELF).ru_maxrss/1024
+		if args.segments > 1:
+			stats['peak_rss_children_mb'] = resource.getrusage(
+							resource.RUSAGE_CHILDREN).ru_maxrss/1024
+		conn.send(stats)
+	except Exception as e:
+		conn.send(e)
+	finally:
+		conn.close()
+
+def benchmark(vid_file, case, args):
+
+	runs = []
+	for i in range(args.repeat):
+		output = os.path.join(args.work_dir, "rhythms")
+		shutil.rmtree(output, ignore_errors=True)
+		parent, child = mp.Pipe(duplex=False)
+		process = mp.Process(target=run_case, args=(vid_file, case, args,
+												   output, child))
+		process.start()
+		child.close()
+		result = parent.recv()
+		process.join()
+		if isinstance(result, Exception):
+			raise result
+		runs.append(result)
+	shutil.rmtree(os.path.join(args.work_dir, "rhythms"), ignore_errors=True)
+
+	best = min(runs, key=lambda run: run['total'])
+	result = dict(case)
+	result.update(best)
+	result['fps'] = best['frames']/best['total'] if best['total'] else 0.0
+	result['runs'] = [run['total'] for run in runs]
+	return result
+
+def _main(args):
+
+	width, height = args.resolution
+	vid_file = os.path.join(args.work_dir, "videos", "synthetic_{}x{}_{}_{}{}"
+				.format(width, height, args.length, args.fourcc,
+						args.video_ext))
+	synthetic_video(vid_file, width, height, args.length, args.fps,
+					args.fourcc)
+
+	report = {
+		'video': {'file': vid_file, 'width': width, 'height': height,
+				  'length': args.length, 'fourcc': args.fourcc,
+				  'size_mb': os.path.getsize(vid_file)/2**20},
+		'settings': {'block_size': args.block_size,
+					 'queue_depth': args.queue_depth, 'backend': args.backend,
+					 'segments': args.segments,
+					 'frame_stride': args.frame_stride,
+					 'rhythm_size': args.rhythm_size, 'ext': args.ext,
+					 'sigma': args.sigma, 'size': args.size,
+					 'repeat': args.repeat},
+		'machine': {'platform': platform.platform(),
+					'processor': platform.processor(),
+					'cpus': os.cpu_count(), 'python': platform.python_version(),
+					'opencv': cv2.__version__, 'numpy': np.__version__},
+		'results': []
+	}
+
+	for case in benchmark_cases(args):
+		result = benchmark(vid_file, case, args)
+		print("{mode} {direction} {color_mode} {percentil}: {fps:.1f} fps, "
+			  "{peak_rss_mb:.0f} MB".format(**result), file=sys.stderr, flush=True)
+		report['results'].append(result)
+
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, sort_keys=True, indent=4)
+	else:
+		print(json.dumps(report, sort_keys=True, indent=4))
+
+if __name__ == '__main__':
+	# parse arguments
+	args = _get_Args()
+	_main(args)
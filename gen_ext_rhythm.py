@@ -6,6 +6,9 @@ import shutil
 from list_dir import list_dir, write_list
 from parallelize_script import parallelize
 from SplitScript import _main as split_files
+from VideoCapture import rhythm_folder_name
+from rhythm_cache import CACHE_DIR
+from rhythm_shards import pack_dataset
 
 
 def _get_Args():
@@ -36,6 +39,16 @@ def _get_Args():
 				help= "Relative position to extract the rhythm", nargs='+')
 	parser.add_argument("-cm", "--color_mode", default='rgb',
 				help= "Color mode", choices=['rgb', 'gray', 'ic'])
+	parser.add_argument("-b", "--backend", default='cv2',
+				help= "Library used to decode the videos", choices=['cv2', 'av'])
+	parser.add_argument("-xs", "--extract_stride", type=int, default=1,
+				help = "Extract the rhythm from one of every this many frames, skipping the others without decoding them")
+	parser.add_argument("-cd", "--cache_dir", default=CACHE_DIR,
+				help = "Persistent cache of rhythms, so only new or changed videos are extracted again. Pass an empty string to disable it")
+	parser.add_argument("-rs", "--rhythm_size", type=int,
+				help = "Downscale the frames before extracting the rhythm, so it already has this many rows. Usually the same of --target_size")
+	parser.add_argument("--shards", action="store_true",
+				help = "Also pack each split into a few large shards with an index, saved on a sibling folder ending in _shards")
 	parser.add_argument("-fs", "--frame_mask", type=int, default=1,
 				help = "Sample image by picking frames in jumps of this value")
 	parser.add_argument("-ts", "--target_size", type=int, default=224,
@@ -87,6 +100,15 @@ def split_rhythms(db, rhythm_dir, rhythm_split_dir, split_folder, file_mask, ext
 		with open(filepath, 'w') as fp:
 			json.dump(data, fp, sort_keys=True, indent=4)
 
+def pack_splits(rhythm_split_dir, rhythm_folder):
+
+	# the stores can be given to applications_train and TTA_Model in place of
+	# the split folders
+	for i in range(1,4):
+		split_dir = os.path.join(rhythm_split_dir, rhythm_folder + "_split{}".format(i))
+		if os.path.isdir(split_dir):
+			pack_dataset(split_dir, split_dir + "_shards")
+
 def split_augmented_rhythms(db, rhythm_dir, rhythm_split_dir, split_folder, file_mask, ext, data, aug_factor):
 
 	db = db.lower()
@@ -113,18 +135,16 @@ def split_augmented_rhythms(db, rhythm_dir, rhythm_split_dir, split_folder, file
 			json.dump(data, fp, sort_keys=True, indent=4)
 
 def create_rhythms(db_name, path, mode, color_mode, direction, size, sigma,
-				   percentil, ext, outdir, split_folder, split_file_mask):
+				   percentil, ext, outdir, split_folder, split_file_mask,
+				   backend='cv2', extract_stride=1, cache_dir=CACHE_DIR,
+				   shards=False, rhythm_size=None):
 
 	db_name = db_name or get_db_name(path)
 	temp_dir = "temp_dir"
 
-	if mode == 'gaussian':
-		rhythm_folder = "{}_VR_{}_{}_Gaussian_SZ_{}_SG_{}_P_{}".format(db_name,
-		color_mode, direction, size, sigma, percentil).upper()
-
-	else:
-		rhythm_folder = "{}_VR_{}_{}_Mean_SZ_{}_SG_{}_P_{}".format(db_name,
-		color_mode, direction, size, sigma, percentil).upper()
+	rhythm_folder = rhythm_folder_name(db_name, mode, direction, sigma, size,
+									   percentil, color_mode, extract_stride,
+									   rhythm_size)
 
 	rhythm_dir =  os.path.join(temp_dir, rhythm_folder)
 	# listar diretorios
@@ -142,12 +162,21 @@ def create_rhythms(db_name, path, mode, color_mode, direction, size, sigma,
 		'direction': direction,
 		'percentil': ' '.join(map(str, percentil)),
 		'color': color_mode,
-		'db_name': db_name
+		'db_name': db_name,
+		'backend': backend,
+		'extract_stride': extract_stride,
+		'rhythm_size': rhythm_size
 	}
 
 	parameters = ("{output} -e {ext} -m {mode} -sg {sigma} -s {size} " +
 				  "-d {direction} -p {percentil} -c {color} -db " +
-				  "{db_name} -kds 1").format(**data)
+				  "{db_name} -kds 1 -b {backend} " +
+				  "-fs {extract_stride}").format(**data)
+	if cache_dir:
+		# kept out of temp_dir, so it survives the end of the run
+		parameters += " -cd {}".format(os.path.abspath(cache_dir))
+	if rhythm_size:
+		parameters += " -rs {}".format(rhythm_size)
 
 	params_file = os.path.join(temp_dir,
 					"temp_params_rhythm_{}.txt".format(db_name))
@@ -162,12 +191,14 @@ def create_rhythms(db_name, path, mode, color_mode, direction, size, sigma,
 	rhythm_split_dir = os.path.join(outdir, rhythm_folder)
 	split_rhythms(db_name, rhythm_dir, rhythm_split_dir, split_folder,
 				  split_file_mask, '.jpg', data)
+	if shards:
+		pack_splits(rhythm_split_dir, rhythm_folder)
 
 	return rhythm_folder, rhythm_dir, data
 
 def extend_rhythms(db_name, rhythm_folder, rhythm_dir, data, num, crop, stride,
 				   target_size, frame_mask, outdir, split_folder,
-				   split_file_mask):
+				   split_file_mask, shards=False):
 
 	db_name = db_name or get_db_name(path)
 	temp_dir = "temp_dir"
@@ -211,6 +242,8 @@ def extend_rhythms(db_name, rhythm_folder, rhythm_dir, data, num, crop, stride,
 	split_augmented_rhythms(db_name, rhythm_da_dir, rhythm_da_split_dir,
 		split_folder, split_file_mask, '.jpg', {**data, **data2},
 		frame_mask*num*crop)
+	if shards:
+		pack_splits(rhythm_da_split_dir, rhythm_da_folder)
 
 	print("Removing temporary files...")
 	# remover arquivos dos ritmos
@@ -223,12 +256,14 @@ def _main(args):
 	rhythm_folder, rhythm_dir, data = create_rhythms(args.database_name,
 				   args.dir, args.mode, args.color_mode, args.direction,
 				   args.size, args.sigma, args.percentil, args.ext,
-				   args.outdir, args.split_folder, args.split_file_mask)
+				   args.outdir, args.split_folder, args.split_file_mask,
+				   args.backend, args.extract_stride, args.cache_dir,
+				   args.shards, args.rhythm_size)
 
 	extend_rhythms(args.database_name, rhythm_folder, rhythm_dir, data,
 				   args.num, args.crop, args.stride, args.target_size,
 				   args.frame_mask, args.outdir, args.split_folder,
-				   args.split_file_mask)
+				   args.split_file_mask, args.shards)
 
 if __name__ == '__main__':
 	# parse arguments
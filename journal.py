@@ -0,0 +1,68 @@
+import os
+import json
+import time
+
+def ends_line(filename):
+
+	with open(filename, "rb") as f:
+		f.seek(-1, os.SEEK_END)
+		return f.read(1) == b"\n"
+
+class Journal():
+
+	# append only file of json lines, one record for each finished item, so
+	# a run can be resumed by skipping the items already done. The last
+	# record of an item is the one that counts, reruns only append to it
+
+	def __init__(self, filename):
+
+		self.filename = filename
+		self.records = {}
+		if os.path.isfile(filename):
+			with open(filename, "r") as f:
+				for line in f:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						# line cut by a run that was killed while writing
+						continue
+					self.records[record['key']] = record
+		os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+		self.file = open(filename, "a")
+		if self.file.tell() and not ends_line(filename):
+			# ends the line cut by a killed run, so the next record isn't
+			# appended to it
+			self.file.write("\n")
+			self.file.flush()
+
+	def record(self, key, status, **info):
+
+		record = {'key': key, 'status': status, 'time': time.time()}
+		record.update(info)
+		# one write of the whole line, flushed so a killed run keeps it
+		self.file.write(json.dumps(record, sort_keys=True) + "\n")
+		self.file.flush()
+		self.records[key] = record
+		return record
+
+	def status(self, key):
+
+		record = self.records.get(key)
+		return record['status'] if record else None
+
+	def done(self):
+		return {key for key, record in self.records.items()
+				if record['status'] == 'done'}
+
+	def failed(self):
+		return [record for record in self.records.values()
+				if record['status'] == 'failed']
+
+	def close(self):
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
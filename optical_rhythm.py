@@ -2,98 +2,303 @@ import cv2
 import numpy as np
 import os
 import argparse
-import matplotlib.pyplot as plt
+import json
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from async_writer import shared_writer
+import rhythm_kernels
+from VideoCapture import open_video, BACKENDS
 
 DIRECTION = {
 				'H': 0,
 				'V': 1
 			}
 
+# number of flow frame pairs reduced at once
+TENSOR_BLOCK = 64
+# flow values mapped to the [0, 255] range of the flow images
+BOUND = 20.0
+# flow image pairs read ahead of the reduction, and threads reading them
+PREFETCH_DEPTH = 8
+READ_THREADS = 4
+
 def _get_Args():
 
 	parser = argparse.ArgumentParser()
-	parser.add_argument("input", help = "Directory with a sample flow")
+	parser.add_argument("input", help = "Directory with a sample flow or a video file, whose flow is computed without saving it")
 	parser.add_argument("output", help = "Output dir")
 	parser.add_argument("-e", "--ext", help= "Extension of output", default=".png")
 	#parser.add_argument("-m", "--mode", help= "Capture mode", default="mean", choices=['mean', 'gaussian'])
 	#parser.add_argument("-sg", "--sigma", type=float, help= "Standard deviation to use whitin gaussian filter", default=1.0)
 	#parser.add_argument("-s", "--size", type=float, help= "Filter size", default=3.0)
 	parser.add_argument("-d", "--direction", help= "Visual rhythm direction", choices=["V", "H", "v", "h"], default='H')
+	parser.add_argument("-f", "--flow", help= "Dense optical flow computed from a video input", choices=["dis", "farneback"], default='dis')
+	parser.add_argument("-bd", "--bound", help= "Flow values in [-bound, bound] are mapped to [0, 255], like the flow images", type=float, default=BOUND)
+	parser.add_argument("-b", "--backend", help= "Library used to decode a video input", choices=BACKENDS, default='cv2')
+	parser.add_argument("-qd", "--queue_depth", help= "Number of flow image pairs read ahead by the reading threads. Use 0 to read them on the main thread", type=int, default=PREFETCH_DEPTH)
+	parser.add_argument("-nt", "--read_threads", help= "Number of threads reading the flow images", type=int, default=READ_THREADS)
+	parser.add_argument("-g", "--gray_decode", help= "Decode the flow images straight to gray. Faster, but the jpeg decoder gives slightly different values than converting the bgr image", action="store_true")
+	parser.add_argument("--stats", help= "Print the time spent reading the flow and reducing it", action="store_true")
 	#parser.add_argument("-p", "--percentil", help= "Relative position to extract the rhythm", type=float, default=[0.5], nargs='+')
 	#parser.add_argument("-c", "--color_mode", help= "Relative position to extract the rhythm", choices=['rgb', 'gray'], default='gray')
 
 	return parser.parse_args()
 
+def block_tensor(flow_x, flow_y, direction):
+
+	# flow_x and flow_y hold n gray frames stacked on the first axis. The
+	# products are taken in uint8 and wrap around at 256, like the rhythms
+	# always had them, and are summed exactly in uint32 before the division.
+	# Returns the means of x*x, y*y and x*y of each frame as (frames, rows, 3)
+	ax = DIRECTION[direction] + 1
+	x = flow_x
+	y = flow_y
+	product = np.empty_like(x)
+	sums = []
+	for a, b in ((x, x), (y, y), (x, y)):
+		np.multiply(a, b, out=product)
+		sums.append(product.sum(axis=ax, dtype=np.uint32))
+	return np.stack(sums, axis=-1) / flow_x.shape[ax]
+
 def frame_tensor(flow_x, flow_y, direction, flow_shape):
 
-	x2 = flow_x**2
-	y2 = flow_y**2
-	xy = flow_x*flow_y
+	# single frame version of block_tensor
+	if direction not in DIRECTION:
+		raise ValueError("Check passed direction: {}".format(direction))
+	return block_tensor(np.expand_dims(flow_x, axis=0),
+						np.expand_dims(flow_y, axis=0), direction)[0]
 
-	try:
-		ax = DIRECTION[direction]
-		x2_mean = np.sum(x2,axis=ax)/flow_shape[ax]
-		y2_mean = np.sum(y2,axis=ax)/flow_shape[ax]
-		xy_mean = np.sum(xy,axis=ax)/flow_shape[ax]
-		return np.array([[a2, b2, ab] for a2, b2, ab in zip(x2_mean, y2_mean, xy_mean)])
-	except Exception as e:
-		print("Check passed direction: {}".format(e))
-		exit(0)
-	return None
+def new_stats():
 
-def video_tensor(args):
+	# seconds spent by the reading threads on the flow images, waited by the
+	# reduction for them and spent on the reduction
+	return {'frames': 0, 'read': 0.0, 'wait_read': 0.0, 'compute': 0.0}
 
-	args.direction = args.direction.upper()
+def read_flow_image(filename, gray=True, gray_decode=False, out=None):
 
-	# expect folder to have flow x, y and rgb image
-	total_frames = len(os.listdir(args.input))//3
+	# out is the gray buffer of a previous image, reused when it fits
+	flow = cv2.imread(filename, cv2.IMREAD_GRAYSCALE if gray_decode
+					  else cv2.IMREAD_COLOR)
+	if flow is None:
+		raise IOError("Failed to read image {}".format(filename))
+	if not gray or gray_decode:
+		return flow
+	if out is None or out.shape != flow.shape[:2]:
+		out = np.empty(flow.shape[:2], dtype=np.uint8)
+	cv2.cvtColor(flow, cv2.COLOR_BGR2GRAY, dst=out)
+	return out
 
-	for i in range(total_frames):
+def flow_images(folder, queue_depth=PREFETCH_DEPTH, threads=READ_THREADS,
+				gray=True, gray_decode=False, stats=None):
 
-		img_x = os.path.join(args.input, "flow_x_{:05d}.jpg".format(i+1))
-		flow_x = cv2.imread(img_x)
-		if flow_x is None:
-			print("Failed to read image {}".format(img_x))
-			exit(0)
+	# pairs of flow images extracted beforehand, as flow_x_%05d.jpg and
+	# flow_y_%05d.jpg (and the rgb image) in the folder, converted to gray
+	# unless gray is False. The pairs are only valid until the next one is
+	# asked for, as their buffers are then reused
+	stats = new_stats() if stats is None else stats
+	total_frames = len(os.listdir(folder))//3
 
-		img_y = os.path.join(args.input, "flow_y_{:05d}.jpg".format(i+1))
-		flow_y = cv2.imread(img_y)
-		if flow_y is None:
-			print("Failed to read image {}".format(img_y))
-			exit(0)
+	def read(i, pair):
+		start = time.perf_counter()
+		pair = [read_flow_image(os.path.join(folder, "flow_{}_{:05d}.jpg"
+								.format(axis, i+1)), gray, gray_decode, out)
+				for axis, out in zip("xy", pair)]
+		return pair, time.perf_counter() - start
 
-		flow_x = cv2.cvtColor(flow_x, cv2.COLOR_BGR2GRAY)
-		flow_y = cv2.cvtColor(flow_y, cv2.COLOR_BGR2GRAY)
+	if queue_depth < 1:
+		pair = [None, None]
+		for i in range(total_frames):
+			pair, seconds = read(i, pair)
+			stats['read'] += seconds
+			yield pair
+		return
 
-		if i == 0:
-			height, width = flow_x.shape
-			if args.direction == 'H':
-				opt_rtm = np.zeros((width, total_frames, 3))
-			elif args.direction == 'V':
-				opt_rtm = np.zeros((height, total_frames, 3))
+	# the threads read the next queue_depth pairs while this one is reduced.
+	# OpenCV releases the GIL when decoding, so they overlap the storage
+	# latency and the decoding with the reduction
+	with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+		pending = [pool.submit(read, i, [None, None])
+				   for i in range(min(queue_depth, total_frames))]
+		try:
+			for i in range(total_frames):
+				pair, seconds = pending[i % queue_depth].result()
+				stats['read'] += seconds
+				yield pair
+				# the pair was reduced, its buffers are read into again
+				if i + queue_depth < total_frames:
+					pending[i % queue_depth] = pool.submit(read,
+											   i + queue_depth, pair)
+		finally:
+			# the reduction stopped early or has failed
+			for future in pending:
+				future.cancel()
+
+def flow_to_image(flow, bound, out=None):
+
+	# same quantization of the flow images of dense_flow: values in
+	# [-bound, bound] mapped to [0, 255] and clipped
+	image = np.clip(np.rint((flow + bound)*(255/(2*bound))), 0, 255)
+	if out is None:
+		return image.astype(np.uint8)
+	out[:] = image
+	return out
+
+def video_flows(vid_file, method='dis', bound=BOUND, backend='cv2'):
+
+	# dense flow between consecutive frames, computed in process and given as
+	# pairs of gray images, the same the flow folders would have
+	vid = open_video(vid_file, backend, gray=True)
+	if not vid.isOpened():
+		raise IOError("Failed to open video {}".format(vid_file))
+	if method == 'dis':
+		dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM)
 
-		opt_rtm[:,i,:] = frame_tensor(flow_x, flow_y, args.direction, (height, width))
+	prev = None
+	flow_x = flow_y = None
+	try:
+		while True:
+			(flag, frame) = vid.read()
+			if not flag:
+				return
+			if frame.ndim == 3:
+				frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+			if prev is not None:
+				if method == 'dis':
+					flow = dis.calc(prev, frame, None)
+				else:
+					flow = cv2.calcOpticalFlowFarneback(prev, frame, None, 0.5,
+														3, 15, 3, 5, 1.2, 0)
+				if flow_x is None:
+					flow_x = np.empty(frame.shape, dtype=np.uint8)
+					flow_y = np.empty(frame.shape, dtype=np.uint8)
+				flow_to_image(flow[...,0], bound, flow_x)
+				flow_to_image(flow[...,1], bound, flow_y)
+				yield flow_x, flow_y
+			prev = frame
+	finally:
+		vid.release()
+
+def video_tensor(args, stats=None):
+
+	# raises IOError or ValueError when the sample can't be processed and
+	# returns the file of the rhythm, written by the shared writer
+	args.direction = args.direction.upper()
+	if args.direction not in DIRECTION:
+		raise ValueError("Check passed direction: {}".format(args.direction))
+
+	stats = new_stats() if stats is None else stats
 
 	# create class pattern to extract class name and create it folder
 	class_pat = re.compile(r"v_([A-Za-z]+)_g")
 	try:
 		class_name = class_pat.search(args.input).group(1)
 	except AttributeError:
-		print("Failed to extract class pattern. Aborting...")
-		exit(0)
+		raise ValueError("Failed to extract class pattern from {}".format(
+						 args.input))
+
+	if os.path.isfile(args.input):
+		# the flow is computed from the video and never saved
+		vid = open_video(args.input, args.backend)
+		if not vid.isOpened():
+			raise IOError("Failed to open video {}".format(args.input))
+		total_frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT)) - 1
+		vid.release()
+		pairs = video_flows(args.input, args.flow, args.bound, args.backend)
+		name = os.path.splitext(os.path.basename(args.input))[0]
+	else:
+		# expect folder to have flow x, y and rgb image
+		total_frames = len(os.listdir(args.input))//3
+		# the kernels convert the bgr images to gray on their own
+		kernels = False
+		if rhythm_kernels.USE_KERNELS and not args.gray_decode and total_frames:
+			first = read_flow_image(os.path.join(args.input,
+									"flow_x_00001.jpg"), gray=False)
+			kernels = rhythm_kernels.worth_it(total_frames*first.shape[0]*
+											  first.shape[1])
+		pairs = flow_images(args.input, args.queue_depth, args.read_threads,
+							not kernels, args.gray_decode, stats)
+		name = os.path.split(args.input)[-1]
+
+	count = 0
+	pairs = iter(pairs)
+	while count < total_frames:
+		start = time.perf_counter()
+		pair = next(pairs, None)
+		stats['wait_read'] += time.perf_counter() - start
+		if pair is None:
+			break
+		flow_x, flow_y = pair
+		start = time.perf_counter()
+
+		if count == 0:
+			height, width = flow_x.shape[:2]
+			# computed flows and the flow images read for numpy are gray
+			kernels = flow_x.ndim == 3
+			if args.direction == 'H':
+				opt_rtm = np.zeros((width, total_frames, 3))
+			elif args.direction == 'V':
+				opt_rtm = np.zeros((height, total_frames, 3))
+			block_x = np.empty((TENSOR_BLOCK, height, width), dtype=np.uint8)
+			block_y = np.empty((TENSOR_BLOCK, height, width), dtype=np.uint8)
+		i = count
+		count += 1
+
+		if kernels:
+			# gray conversion, products and sums on a single pass
+			opt_rtm[:,i,:] = rhythm_kernels.frame_tensor(flow_x, flow_y,
+														 args.direction)
+			stats['compute'] += time.perf_counter() - start
+			continue
+
+		# the gray frames are gathered in blocks reduced at once
+		j = i % TENSOR_BLOCK
+		if flow_x.ndim == 3:
+			cv2.cvtColor(flow_x, cv2.COLOR_BGR2GRAY, dst=block_x[j])
+			cv2.cvtColor(flow_y, cv2.COLOR_BGR2GRAY, dst=block_y[j])
+		else:
+			block_x[j] = flow_x
+			block_y[j] = flow_y
+		if j == TENSOR_BLOCK - 1:
+			opt_rtm[:,i-j:i+1,:] = block_tensor(block_x, block_y,
+									args.direction).transpose(1, 0, 2)
+		stats['compute'] += time.perf_counter() - start
+	# stops the reading threads (or the decoding), which are still running
+	# when the container had more frames than it told
+	pairs.close()
+
+	if count == 0:
+		raise IOError("No flow frames found on {}".format(args.input))
+	j = count % TENSOR_BLOCK
+	if not kernels and j:
+		# frames left on the last block
+		start = time.perf_counter()
+		opt_rtm[:,count-j:count,:] = block_tensor(block_x[:j], block_y[:j],
+									args.direction).transpose(1, 0, 2)
+		stats['compute'] += time.perf_counter() - start
+	stats['frames'] += count
+	# slices only the frames read
+	opt_rtm = opt_rtm[:,:count]
+
 	output = os.path.join(args.output, class_name)
 	os.makedirs(output, exist_ok = True)
 
-	img_name = os.path.split(args.input)[-1] + args.ext
+	img_name = name + args.ext
 
-	if args.ext == '.npy':
-		np.save(os.path.join(output, img_name), opt_rtm)
-	else:
-		cv2.imwrite(os.path.join(output, img_name), opt_rtm)
+	# .npy files are saved by np.save, the others encoded by OpenCV
+	shared_writer().save(os.path.join(output, img_name), opt_rtm)
+	return os.path.join(output, img_name)
 
 def _main(args):
-	video_tensor(args)
+	stats = new_stats()
+	try:
+		video_tensor(args, stats)
+		shared_writer().flush()
+	except (IOError, ValueError) as e:
+		print("{}. Aborting...".format(e))
+		exit(0)
+	if args.stats:
+		print(json.dumps(stats, sort_keys=True))
 
 if __name__ == '__main__':
 	# parse arguments
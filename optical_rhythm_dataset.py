@@ -0,0 +1,110 @@
+import os
+import argparse
+import fnmatch
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import optical_rhythm
+from async_writer import shared_writer
+from journal import Journal
+from VideoCapture import BACKENDS
+
+def _get_Args():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("input", help = "Root directory searched for the flow folders of the samples (v_*_g*)")
+	parser.add_argument("output", help = "Output dir")
+	parser.add_argument("-e", "--ext", help= "Extension of output", default=".png")
+	parser.add_argument("-d", "--direction", help= "Visual rhythm direction", choices=["V", "H", "v", "h"], default='H')
+	parser.add_argument("-ve", "--video_ext", help= "Search for videos with this extension instead of flow folders, computing their flow in process")
+	parser.add_argument("-f", "--flow", help= "Dense optical flow computed from the videos", choices=["dis", "farneback"], default='dis')
+	parser.add_argument("-bd", "--bound", help= "Flow values in [-bound, bound] are mapped to [0, 255], like the flow images", type=float, default=optical_rhythm.BOUND)
+	parser.add_argument("-b", "--backend", help= "Library used to decode the videos", choices=BACKENDS, default='cv2')
+	parser.add_argument("-qd", "--queue_depth", help= "Number of flow image pairs read ahead by the reading threads of each process", type=int, default=optical_rhythm.PREFETCH_DEPTH)
+	parser.add_argument("-nt", "--read_threads", help= "Number of threads reading the flow images on each process", type=int, default=optical_rhythm.READ_THREADS)
+	parser.add_argument("-g", "--gray_decode", help= "Decode the flow images straight to gray. Faster, but the jpeg decoder gives slightly different values than converting the bgr image", action="store_true")
+	parser.add_argument("-np", "--processes", help= "Number of processes. Defaults to the number of cores", type=int)
+	parser.add_argument("-j", "--journal", help= "Journal of the finished samples, so a rerun skips the ones done. Defaults to journal.jsonl on the output dir")
+	parser.add_argument("--retry", help= "Also process again the samples that failed on previous runs (they are skipped otherwise)", action="store_true")
+
+	return parser.parse_args()
+
+def find_samples(root, video_ext=None, pattern="v_*_g*"):
+
+	# flow folders (or video files) named after the samples, relative to root
+	samples = []
+	for path, dirs, files in os.walk(root):
+		dirs.sort()
+		if video_ext:
+			names = [name for name in sorted(files)
+					 if os.path.splitext(name)[1] == video_ext and
+					 fnmatch.fnmatch(name, pattern)]
+		else:
+			names = [name for name in dirs if fnmatch.fnmatch(name, pattern)]
+			# a flow folder has no folders of samples inside it
+			dirs[:] = [name for name in dirs if name not in names]
+		samples += [os.path.relpath(os.path.join(path, name), root)
+					for name in names]
+	return samples
+
+def process_sample(task):
+
+	# runs on the worker processes, failures are returned instead of raised
+	# so one bad sample doesn't stop the others
+	sample, args = task
+	args = argparse.Namespace(**vars(args))
+	args.input = os.path.join(args.input, sample)
+	start = time.perf_counter()
+	stats = optical_rhythm.new_stats()
+	try:
+		output = optical_rhythm.video_tensor(args, stats)
+		# the sample is only done once its rhythm is on disk
+		shared_writer().flush()
+		return sample, 'done', {'output': output, 'stats': stats,
+								'duration': time.perf_counter() - start}
+	except Exception as e:
+		return sample, 'failed', {'error': "{}: {}".format(type(e).__name__, e),
+								  'traceback': traceback.format_exc(),
+								  'duration': time.perf_counter() - start}
+
+def _main(args):
+
+	journal_file = args.journal or os.path.join(args.output, "journal.jsonl")
+	samples = find_samples(args.input, args.video_ext)
+
+	with Journal(journal_file) as journal:
+		skip = journal.done()
+		if not args.retry:
+			skip |= {record['key'] for record in journal.failed()}
+		pending = [sample for sample in samples if sample not in skip]
+		print("Found {} samples, {} already processed, {} to go".format(
+			  len(samples), len(samples) - len(pending), len(pending)))
+
+		processes = args.processes or os.cpu_count()
+		done = failed = 0
+		# unlike mp.Pool, the workers of the executor aren't daemonic, so the
+		# extraction can start its own processes
+		with ProcessPoolExecutor(max_workers=processes) as pool:
+			futures = [pool.submit(process_sample, (sample, args))
+					   for sample in pending]
+			for future in as_completed(futures):
+				sample, status, info = future.result()
+				journal.record(sample, status, **info)
+				if status == 'done':
+					done += 1
+				else:
+					failed += 1
+					print("Failed {}: {}".format(sample, info['error']))
+				print("{}/{} done, {} failed".format(done, len(pending),
+					  failed), end='\r', flush=True)
+
+		print()
+		print("Processed {} samples, {} failed".format(done, failed))
+		for record in journal.failed():
+			print("  {key}: {error}".format(**record))
+
+if __name__ == '__main__':
+	# parse arguments
+	args = _get_Args()
+	_main(args)
@@ -1,18 +1,42 @@
 import multiprocessing as mp
+import multiprocessing.connection
 import subprocess as sp
 import argparse
+import collections
+import importlib.util
+import json
+import mmap
+import os
+import sys
 import time
+import traceback
 from tqdm import tqdm
+from journal import Journal
 
 encode = "utf-8"
 threads_file = 'threads.txt'
+# seconds between reads of the threads file while no execution finishes
+READ_INTERVAL = 5.0
+# times a failed execution is run again
+RETRIES = 2
+# seconds between samples of the memory of the workers while executions
+# wait for memory
+MEMORY_INTERVAL = 0.5
 
 def _get_Args():
 	parser = argparse.ArgumentParser()
 	parser.add_argument("script", help="Script name to run in parallel")
 	parser.add_argument("files", help="Name of the file with the names of the input files for the script", nargs='+')
 	parser.add_argument("params", help="Name of the file with the extra parameters of script")
-	parser.add_argument("-c","--charge", type=int, help="This value multiplied with number of threads avaiable indicate how many process will run between reads of the file with the number of threads")
+	parser.add_argument("-c","--charge", type=int, help="Unused, kept for compatibility. The file with the number of threads is re-read whenever an execution finishes")
+	parser.add_argument("-o","--order", help="Order the executions start, by the estimated cost of their first input: the size of the file (or of the files of a folder), its number of frames, or the order of the input list", choices=['size', 'frames', 'input'], default='size')
+	parser.add_argument("-hf","--history", help="Json file with the duration of the executions, recorded by previous runs. Executions with a recorded duration are ordered by it, and the others by their estimated cost scaled to seconds")
+	parser.add_argument("-j","--journal", help="Journal of the finished executions. A rerun with the same journal skips the executions done and runs the failed ones again while they have retries left")
+	parser.add_argument("-r","--retries", type=int, help="Times a failed execution is run again, counting the attempts of previous runs on the journal", default=RETRIES)
+	parser.add_argument("-mb","--memory_budget", type=float, help="Megabytes the workers (and their subprocesses) can use together. New executions only start while the memory in use plus the one expected for them fits, although one always runs")
+	parser.add_argument("-mf","--memory_per_frame", type=float, help="Megabytes an execution is expected to use for each frame of its first input. Without it, the biggest memory seen used by a worker is expected")
+	parser.add_argument("-ri","--read_interval", type=float, help="Seconds between reads of the file with the number of threads while no execution finishes", default=READ_INTERVAL)
+	parser.add_argument("-sp","--subprocess", help="Run each execution of the script on a new python process, instead of calling its _main on workers that import it once", action="store_true")
 	return parser.parse_args()
 
 def get_threads():
@@ -40,6 +64,59 @@ def get_files(files):
 		print("A problem ocurred trying to read the file with the names of inputs: ", e)
 		return 1
 		
+# module of the script imported by each worker, None when it runs the
+# script on subprocesses
+worker_module = None
+
+def load_script(script):
+
+	# imports the script as a module named after it, so the modules it uses
+	# are imported only once by the worker and shared with it. Scripts
+	# without _get_Args and _main can only run on subprocesses
+	name = os.path.splitext(os.path.basename(script))[0]
+	sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+	spec = importlib.util.spec_from_file_location(name, script)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[name] = module
+	spec.loader.exec_module(module)
+	if hasattr(module, '_get_Args') and hasattr(module, '_main'):
+		return module
+	return None
+
+def init_worker(script, in_process):
+
+	global worker_module
+	if in_process:
+		try:
+			worker_module = load_script(script)
+		except Exception as e:
+			print("A problem ocurred trying to import {}, running it on subprocesses: ".format(script), e)
+			worker_module = None
+
+def run_script(command):
+
+	# command is the script followed by its arguments, returns the exit code
+	if worker_module is None:
+		return sp.call(['python'] + command)
+
+	# same arguments the script would parse on its own process
+	argv = sys.argv
+	sys.argv = list(command)
+	try:
+		worker_module._main(worker_module._get_Args())
+		return 0
+	except SystemExit as e:
+		# argparse errors and explicit exits of the script
+		if e.code is None:
+			return 0
+		return e.code if isinstance(e.code, int) else 1
+	except Exception:
+		# a failed execution doesn't take the worker down with it
+		traceback.print_exc()
+		return 1
+	finally:
+		sys.argv = argv
+
 def get_params(params_file):
 
 	try:
@@ -51,44 +128,367 @@ def get_params(params_file):
 		print("A problem ocurred trying to read the file with the parameters: ", e)
 		return 1
 	
-def parallelize(script, files, params, charge_factor):
-	
-	if charge_factor == None:
-		charge_factor = 10
+def input_size(name):
+
+	# bytes of a file, or of the files of a folder (like the flow folders)
+	if os.path.isdir(name):
+		return sum(entry.stat().st_size for entry in os.scandir(name)
+				   if entry.is_file())
+	return os.path.getsize(name)
+
+def input_frames(name):
+
+	# frame count told by the container, or the number of files of a folder
+	if os.path.isdir(name):
+		return len(os.listdir(name))
+	import cv2
+	vid = cv2.VideoCapture(name)
+	frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+	vid.release()
+	return max(frames, 0)
+
+def load_history(history_file):
+
+	if history_file is None or not os.path.isfile(history_file):
+		return {}
+	try:
+		with open(history_file, "r", encoding=encode) as input:
+			return json.load(input)
+	except Exception as e:
+		print("A problem ocurred trying to read the history file: ", e)
+		return {}
+
+def save_history(history_file, history):
+
+	# replaced at once, so an interrupted run doesn't leave it broken
+	with open(history_file + ".tmp", "w", encoding=encode) as output:
+		json.dump(history, output, sort_keys=True, indent=1)
+	os.replace(history_file + ".tmp", history_file)
+
+def estimate_costs(commands, inputs, order, history):
+
+	# recorded durations when there are, otherwise the size (or frames) of
+	# the first input times the seconds per byte (or frame) of the recorded
+	# executions, so both are on the same scale
+	if order == 'input':
+		return [0]*len(commands)
+	measure = input_frames if order == 'frames' else input_size
+	units = []
+	for name in inputs:
+		try:
+			units.append(measure(name))
+		except Exception:
+			# missing inputs are cheap, they fail right away
+			units.append(0)
+	keys = [" ".join(command) for command in commands]
+	known = [(history[key], unit) for key, unit in zip(keys, units)
+			 if key in history and unit]
+	rate = sum(d for d, u in known)/sum(u for d, u in known) if known else 1.0
+	return [history.get(key, unit*rate) for key, unit in zip(keys, units)]
+
+def process_rss(pid):
+
+	# resident bytes of the process and of its children, like the
+	# subprocesses of the script, from /proc. 0 if it already ended
+	try:
+		with open("/proc/{}/statm".format(pid), "r") as statm:
+			rss = int(statm.read().split()[1])*mmap.PAGESIZE
+	except (OSError, ValueError, IndexError):
+		return 0
+	try:
+		with open("/proc/{0}/task/{0}/children".format(pid), "r") as children:
+			children = [int(child) for child in children.read().split()]
+	except (OSError, ValueError):
+		children = []
+	return rss + sum(process_rss(child) for child in children)
+
+def build_commands(script, names, params):
+
+	# the script followed by the names of each execution and the parameters
+	commands = []
+	for name in names:
+		command = list(params)
+		[command.insert(0, n) for n in reversed(name)]
+		command.insert(0, script)
+		commands.append(command)
+	return commands
+
+def resume_journal(journal, keys, retries):
+
+	# exit codes and attempts of the executions on the journal. Executions
+	# done, or failed with no retries left, get their code and aren't run
+	# again. Lost executions are recorded without a code
+	codes = [None]*len(keys)
+	attempts = [0]*len(keys)
+	if journal is None:
+		return codes, attempts
+	for index, key in enumerate(keys):
+		record = journal.records.get(key)
+		if record is None:
+			continue
+		attempts[index] = record['attempts']
+		if record['status'] == 'done':
+			codes[index] = 0
+		elif record['attempts'] > retries:
+			codes[index] = record['code'] if record['code'] is not None else -1
+	skipped = sum(code is not None for code in codes)
+	if skipped:
+		print("Skipping {} executions already on the journal".format(skipped))
+	return codes, attempts
+
+def record_execution(journal, key, code, duration, attempts):
+
+	# the key is the whole command, which is all that is known of an
+	# execution. Lost executions are recorded without a code
+	if journal is not None:
+		journal.record(key, 'done' if code == 0 else 'failed', code=code,
+					   duration=duration, attempts=attempts)
+
+def print_failures(codes, keys, retries):
+
+	failed = [index for index, code in enumerate(codes) if code]
+	if failed:
+		print("{} executions failed after {} attempts:".format(len(failed),
+			  retries + 1))
+		for index in failed:
+			print("  [{}] {}".format(codes[index], keys[index]))
+
+def worker_loop(script, in_process, conn):
+
+	# runs the executions sent by parallelize on its own pipe, until it gets
+	# None or the pipe is closed
+	init_worker(script, in_process)
+	while True:
+		try:
+			task = conn.recv()
+		except EOFError:
+			return
+		if task is None:
+			return
+		index, command = task
+		start = time.perf_counter()
+		code = run_script(command)
+		conn.send((index, code, time.perf_counter() - start))
+
+def parallelize(script, files, params, charge_factor, in_process=True,
+				read_interval=READ_INTERVAL, order='size', history_file=None,
+				journal_file=None, retries=RETRIES, memory_budget=None,
+				memory_per_frame=None):
 	
+	# charge_factor is kept for compatibility, the number of threads is now
+	# re-read while the executions run
 	names = get_files(files)
 	params = get_params(params)
-	# Number of scripts already executed
-	executions = 0
+	commands = build_commands(script, names, params)
 	# Maximun number of scripts executions
-	max_executions = len(names)
+	max_executions = len(commands)
 	
-	with tqdm(total=max_executions, ascii=True) as pbar:
-		while executions < max_executions:
+	# longest executions first, so a big video doesn't start last and run
+	# alone on a single core at the end
+	history = load_history(history_file)
+	costs = estimate_costs(commands, [name[0] for name in names], order,
+						   history)
+	
+	# exactly num_threads executions are in flight at any time. A new one
+	# starts as soon as another finishes, and the number of threads is
+	# re-read on every finished execution (and every read_interval seconds),
+	# growing or shrinking the workers without waiting the others to finish.
+	# Each worker has its own pipe, and the execution sent to each one is
+	# kept here, so the one of a worker that dies is always known
+	workers = {}
+	# pid -> index of the execution sent to the worker
+	assigned = {}
+	# workers told to stop, joined at the end
+	stopped = []
+	num_threads = get_threads()
+	num_threads = 1 if num_threads is None else max(num_threads, 0)
+	last_read = time.monotonic()
+	
+	# executions done on previous runs are skipped, and the failed ones only
+	# keep the attempts left. The journal is appended after every execution,
+	# so a run killed at any point resumes from there
+	keys = [" ".join(command) for command in commands]
+	journal = Journal(journal_file) if journal_file is not None else None
+	codes, attempts = resume_journal(journal, keys, retries)
+	pending = collections.deque(sorted((index for index in
+									   range(max_executions) if
+									   codes[index] is None),
+									   key=lambda index: -costs[index]))
+	
+	# memory expected for each execution, from the frames of its first input
+	# when memory_per_frame is given, or learned from the workers otherwise
+	estimates = None
+	if memory_budget is not None and memory_per_frame is not None:
+		estimates = []
+		for name in names:
+			try:
+				estimates.append(input_frames(name[0])*memory_per_frame*2**20)
+			except Exception:
+				estimates.append(0)
+	# the most a finished execution has grown a worker over its idle memory.
+	# Only trusted once an execution has finished, a running one may not
+	# have allocated its memory yet
+	peak = 0
+	learned = False
+	idle = {}
+	# index -> (bytes now, most bytes) grown by the running executions
+	grown = {}
+	
+	def sample_memory():
+		# sampled on every pass of the loop, so the most an execution grows
+		# is seen even if no other one waits for memory then
+		used = 0
+		for pid in workers:
+			rss = process_rss(pid)
+			used += rss
+			if pid in assigned:
+				index = assigned[pid]
+				now = rss - idle.get(pid, 0)
+				grown[index] = (now, max(now, grown.get(index, (0, 0))[1]))
+			else:
+				idle[pid] = rss
+		return used
+	
+	def memory_fits(index, used):
+		# executions queued or just started haven't allocated their memory
+		# yet, so they count as their estimate until they use more
+		if estimates is None and not learned:
+			# nothing known about the executions until one has finished, so
+			# they run one at a time
+			return False
+		expected = lambda i: estimates[i] if estimates is not None else peak
+		for i in assigned.values():
+			used += max(expected(i) - grown.get(i, (0, 0))[0], 0)
+		return used + expected(index) <= memory_budget*2**20
+	
+	def finish(index, code, duration):
+		nonlocal peak, learned
+		if index in grown:
+			peak = max(peak, grown.pop(index)[1])
+			learned = True
+		attempts[index] += 1
+		record_execution(journal, keys[index], code, duration, attempts[index])
+		if code == 0:
+			history[keys[index]] = duration
+		elif attempts[index] <= retries:
+			# runs again after the executions already waiting
+			pending.append(index)
+			return
+		codes[index] = code
+		pbar.update(1)
+	
+	# the workers aren't daemonic, so the scripts they run can start their
+	# own processes (like the segments of VideoCapture). They are stopped
+	# explicitly when the run ends, or killed if it fails
+	try:
+		with tqdm(total=len(pending), ascii=True) as pbar:
+			while pending or assigned:
 			
-			num_threads = get_threads()
-			executions_interval = min(charge_factor*num_threads, max_executions - executions)
-			configurations = []
-			#print(time.ctime(), " Executing task ",executions," to ", executions+executions_interval, " of ", max_executions)
+				if time.monotonic() - last_read >= read_interval:
+					threads = get_threads()
+					# keeps the last value if the file can't be read. 0 pauses
+					num_threads = num_threads if threads is None else max(threads, 0)
+					last_read = time.monotonic()
 			
-			for i in range(executions_interval):
-				command = list(params)
-				[command.insert(0, name) for name in reversed(names[executions])]
-				command.insert(0, script)
-				command.insert(0, 'python')
-				configurations.append(command)
-				executions = executions + 1
-				
-			pool = mp.Pool(processes=num_threads)
-			pool.map(sp.call, configurations)
-			pool.close()
-			pbar.update(executions_interval)
-	
+				for _ in range(num_threads - len(workers)):
+					conn, child = mp.Pipe()
+					worker = mp.Process(target=worker_loop,
+								args=(script, in_process, child))
+					worker.start()
+					child.close()
+					workers[worker.pid] = (worker, conn)
+				# idle workers above the number of threads, busy ones are only
+				# stopped after their execution
+				idle_workers = [pid for pid in workers if pid not in assigned]
+				for pid in idle_workers[:max(len(workers) - num_threads, 0)]:
+					worker, conn = workers.pop(pid)
+					try:
+						conn.send(None)
+					except OSError:
+						pass
+					conn.close()
+					stopped.append(worker)
 			
+				# with a memory budget, executions only start while there's
+				# headroom for them. One always runs, even if it doesn't fit
+				if memory_budget is not None:
+					used = sample_memory()
+				for pid in [pid for pid in workers if pid not in assigned]:
+					if not pending:
+						break
+					if memory_budget is not None and assigned and \
+					   not memory_fits(pending[0], used):
+						break
+					index = pending.popleft()
+					if memory_budget is not None:
+						# what the execution grows is measured from here
+						idle[pid] = process_rss(pid)
+						grown[index] = (0, 0)
+					assigned[pid] = index
+					try:
+						workers[pid][1].send((index, commands[index]))
+					except OSError:
+						# died already, handled with the other dead workers
+						pass
+			
+				# waits for a result or the end of a worker. The memory of the
+				# running executions is sampled more often
+				ready = mp.connection.wait([conn for worker, conn in
+						workers.values()] + [worker.sentinel for worker, conn
+						in workers.values()], timeout=MEMORY_INTERVAL
+						if memory_budget is not None and assigned else
+						read_interval)
+				for pid, (worker, conn) in list(workers.items()):
+					if conn not in ready and worker.sentinel not in ready:
+						continue
+					try:
+						while conn.poll():
+							index, code, duration = conn.recv()
+							del assigned[pid]
+							finish(index, code, duration)
+							# the file is re-read before the next one starts
+							last_read = 0
+						if worker.is_alive():
+							continue
+					except (EOFError, OSError):
+						# the pipe closes only when the worker exits
+						pass
+					worker.join()
+					conn.close()
+					del workers[pid]
+					if pid in assigned:
+						# died during an execution, which counts as failed
+						index = assigned.pop(pid)
+						print("Worker crashed running {}".format(keys[index]))
+						finish(index, worker.exitcode, None)
+	except BaseException:
+		for worker, conn in workers.values():
+			worker.terminate()
+		raise
+	
+	for worker, conn in workers.values():
+		try:
+			conn.send(None)
+		except OSError:
+			pass
+		conn.close()
+		stopped.append(worker)
+	for worker in stopped:
+		worker.join()
+	if history_file is not None:
+		save_history(history_file, history)
+	if journal is not None:
+		journal.close()
+	
+	print_failures(codes, keys, retries)
+	return codes
 	
 def _main(args):
 	
-	parallelize(args.script, args.files, args.params, args.charge)
+	parallelize(args.script, args.files, args.params, args.charge,
+				not args.subprocess, args.read_interval, args.order, args.history,
+				args.journal, args.retries, args.memory_budget,
+				args.memory_per_frame)
 	
 if __name__ == '__main__':
 	# parse arguments
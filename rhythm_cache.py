@@ -0,0 +1,91 @@
+import os
+import json
+import hashlib
+import shutil
+
+# default folder of the persistent rhythm cache
+CACHE_DIR = "rhythm_cache"
+# size of the pieces read when hashing a video
+HASH_CHUNK = 2**20
+
+def link_file(src, dst):
+
+	# hard links share the data with the cache, copies are only used when the
+	# cache is on another file system. The link is made on a temporary name
+	# and renamed, so parallel workers never see half written files
+	tmp = "{}.{}.tmp".format(dst, os.getpid())
+	try:
+		os.link(src, tmp)
+	except OSError:
+		shutil.copy2(src, tmp)
+	os.replace(tmp, dst)
+
+def file_digest(filename):
+
+	sha = hashlib.sha1()
+	with open(filename, "rb") as f:
+		for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+			sha.update(chunk)
+	return sha.hexdigest()
+
+def video_key(vid_file, cache_dir=CACHE_DIR, method='content'):
+
+	# 'content' hashes the whole file, so duplicated clips share their
+	# rhythms. The hash is kept on the cache and only recomputed when size or
+	# modification time change. 'stat' uses the path, size and modification
+	# time, without reading the file
+	info = os.stat(vid_file)
+	path = os.path.abspath(vid_file)
+	if method == 'stat':
+		return hashlib.sha1("{}:{}:{}".format(path, info.st_size,
+							info.st_mtime_ns).encode()).hexdigest()
+
+	hashes = os.path.join(cache_dir, "hashes")
+	os.makedirs(hashes, exist_ok=True)
+	memo = os.path.join(hashes, hashlib.sha1(path.encode()).hexdigest() +
+						".json")
+	try:
+		with open(memo, "r") as f:
+			data = json.load(f)
+		if data['size'] == info.st_size and data['mtime'] == info.st_mtime_ns:
+			return data['digest']
+	except (OSError, ValueError, KeyError):
+		pass
+
+	data = {'path': path, 'size': info.st_size, 'mtime': info.st_mtime_ns,
+			'digest': file_digest(vid_file)}
+	with open(memo + ".{}.tmp".format(os.getpid()), "w") as f:
+		json.dump(data, f)
+	os.replace(memo + ".{}.tmp".format(os.getpid()), memo)
+	return data['digest']
+
+def rhythm_key(vid_key, params):
+
+	# params holds everything that changes the content of the rhythm
+	text = json.dumps(params, sort_keys=True)
+	return hashlib.sha1("{}:{}".format(vid_key, text).encode()).hexdigest()
+
+def object_files(cache_dir, key, files):
+
+	objects = os.path.join(cache_dir, "objects", key[:2])
+	return [os.path.join(objects, "{}_{}{}".format(key, i,
+			os.path.splitext(filename)[1])) for i, filename in enumerate(files)]
+
+def fetch(cache_dir, key, files):
+
+	# links the cached rhythm into its output files, returns False when the
+	# rhythm isn't on the cache
+	objects = object_files(cache_dir, key, files)
+	if not all(os.path.isfile(obj) for obj in objects):
+		return False
+	for obj, filename in zip(objects, files):
+		if not (os.path.isfile(filename) and os.path.samefile(obj, filename)):
+			link_file(obj, filename)
+	return True
+
+def store(cache_dir, key, files):
+
+	objects = object_files(cache_dir, key, files)
+	os.makedirs(os.path.dirname(objects[0]), exist_ok=True)
+	for obj, filename in zip(objects, files):
+		link_file(filename, obj)
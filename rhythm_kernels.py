@@ -0,0 +1,269 @@
+import numpy as np
+import argparse
+import importlib.util
+
+# numba takes about a second to import, so it's only imported when the
+# kernels are first used
+HAVE_NUMBA = importlib.util.find_spec("numba") is not None
+
+# fixed point coefficients (shift, b, g, r) used by cv2.cvtColor
+# (COLOR_BGR2GRAY) on uint8 images, which changed between OpenCV versions
+GRAY_COEFFICIENTS = [(14, 1868, 9617, 4899), (15, 3735, 19235, 9798)]
+
+# pixels a process has to reduce before the kernels pay back the import of
+# numba on the cases they speed up the least. Once imported they are always
+# used
+IMPORT_PIXELS = 2**31
+
+# names of the functions compiled by numba
+KERNELS = []
+compiled = False
+
+def jit(function):
+
+	KERNELS.append(function.__name__)
+	return function
+
+def compile_kernels():
+
+	# replaces the functions of the module by their compiled versions, in
+	# the order they were defined so the kernels call the compiled helpers.
+	# They are cached on disk and release the GIL, so the decoding thread
+	# runs alongside
+	global compiled
+	if not compiled:
+		import numba
+		for name in KERNELS:
+			globals()[name] = numba.njit(cache=True, nogil=True)(globals()[name])
+		compiled = True
+
+def _get_Args():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-n", "--trials", help="Random blocks tested for each kernel", type=int, default=3)
+	parser.add_argument("-sd", "--seed", type=int, default=0)
+	return parser.parse_args()
+
+def bgr_to_gray(frames, coef):
+
+	# numpy version of the conversion fused into the kernels
+	shift, b, g, r = coef
+	frames = frames.astype(np.int32)
+	return ((frames[...,0]*b + frames[...,1]*g + frames[...,2]*r +
+			 (1 << (shift - 1))) >> shift).astype(np.uint8)
+
+def gray_coefficients():
+
+	# the coefficients giving the same values of the installed OpenCV on a
+	# probe of random colors, None if none of them does. Then gray rhythms
+	# keep using cv2.cvtColor
+	import cv2
+	probe = np.random.RandomState(0).randint(0, 256, (1, 2**16, 3))
+	probe = probe.astype(np.uint8)
+	expected = cv2.cvtColor(probe, cv2.COLOR_BGR2GRAY)
+	for coef in GRAY_COEFFICIENTS:
+		if np.array_equal(bgr_to_gray(probe, coef), expected):
+			return np.array(coef, dtype=np.int32)
+	return None
+
+# the kernels are only used with numba and a gray conversion matching OpenCV
+GRAY = gray_coefficients() if HAVE_NUMBA else None
+USE_KERNELS = GRAY is not None
+
+def worth_it(pixels):
+
+	# whether a job reducing this many pixels should use the kernels
+	return USE_KERNELS and (compiled or pixels >= IMPORT_PIXELS)
+
+@jit
+def _gray(b, g, r, coef):
+	return (np.int32(b)*coef[1] + np.int32(g)*coef[2] + np.int32(r)*coef[3] +
+			(1 << (coef[0] - 1))) >> coef[0]
+
+@jit
+def _mean_kernel(block, horizontal, gray, coef, out):
+
+	# block is (frames, height, width, 3) in bgr. Each frame is read once,
+	# converted to gray on the fly if needed and summed in integers along
+	# the reduced axis, then floored like mean_rhythm_block. The loops are
+	# split by case so the inner ones have no branches
+	n, height, width, _ = block.shape
+	channels = out.shape[2]
+	length = height if horizontal else width
+	acc = np.zeros((out.shape[0], channels), dtype=np.uint32)
+	for f in range(n):
+		acc[:] = 0
+		frame = block[f]
+		if horizontal and gray:
+			for y in range(height):
+				for x in range(width):
+					acc[x,0] += _gray(frame[y,x,0], frame[y,x,1],
+									  frame[y,x,2], coef)
+		elif horizontal:
+			for y in range(height):
+				for x in range(width):
+					acc[x,0] += frame[y,x,0]
+					acc[x,1] += frame[y,x,1]
+					acc[x,2] += frame[y,x,2]
+		elif gray:
+			for y in range(height):
+				total = np.uint32(0)
+				for x in range(width):
+					total += _gray(frame[y,x,0], frame[y,x,1], frame[y,x,2],
+								   coef)
+				acc[y,0] = total
+		else:
+			for y in range(height):
+				b = g = r = np.uint32(0)
+				for x in range(width):
+					b += frame[y,x,0]
+					g += frame[y,x,1]
+					r += frame[y,x,2]
+				acc[y,0] = b
+				acc[y,1] = g
+				acc[y,2] = r
+		for i in range(out.shape[0]):
+			for c in range(channels):
+				out[i,f,c] = acc[i,c] // length
+
+@jit
+def _gaussian_kernel(block, horizontal, gray, coef, weights, windows, out):
+
+	# windows holds, for each percentile line, the rows (or columns) of the
+	# filter window with the reflect border already applied. Only these are
+	# read and converted. The sum follows the order of scipy's symmetric
+	# correlation and is truncated to uint8, like gaussian_rhythm_block
+	n, height, width, _ = block.shape
+	channels = 1 if gray else 3
+	rows = width if horizontal else height
+	radius = weights.shape[0] - 1
+	values = np.empty((windows.shape[1], rows, channels), dtype=np.float64)
+	for f in range(n):
+		for p in range(windows.shape[0]):
+			for i in range(windows.shape[1]):
+				line = windows[p,i]
+				for r in range(rows):
+					y = line if horizontal else r
+					x = r if horizontal else line
+					if gray:
+						values[i,r,0] = _gray(block[f,y,x,0], block[f,y,x,1],
+											  block[f,y,x,2], coef)
+					else:
+						for c in range(channels):
+							values[i,r,c] = block[f,y,x,c]
+			for r in range(rows):
+				for c in range(channels):
+					acc = values[radius,r,c] * weights[0]
+					for i in range(radius, 0, -1):
+						acc += (values[radius-i,r,c] +
+								values[radius+i,r,c]) * weights[i]
+					out[r,f,p*channels + c] = np.uint8(int(acc))
+
+@jit
+def _tensor_kernel(flow_x, flow_y, horizontal, coef, out):
+
+	# flow images are bgr, converted to gray on the fly. The products wrap
+	# around at 256 and the sums are exact, like optical_rhythm.block_tensor
+	height, width, _ = flow_x.shape
+	length = height if horizontal else width
+	acc = np.zeros((out.shape[0], 3), dtype=np.int64)
+	for y in range(height):
+		for x in range(width):
+			a = _gray(flow_x[y,x,0], flow_x[y,x,1], flow_x[y,x,2], coef)
+			b = _gray(flow_y[y,x,0], flow_y[y,x,1], flow_y[y,x,2], coef)
+			i = x if horizontal else y
+			acc[i,0] += (a*a) & 255
+			acc[i,1] += (b*b) & 255
+			acc[i,2] += (a*b) & 255
+	for i in range(out.shape[0]):
+		for c in range(3):
+			out[i,c] = acc[i,c] / length
+
+def mean_rhythm_block(block, direction='H', gray=False):
+
+	# same output of VideoCapture.mean_rhythm_block, from bgr frames
+	horizontal = direction == 'H'
+	rows = block.shape[2] if horizontal else block.shape[1]
+	out = np.empty((rows, block.shape[0], 1 if gray else 3), dtype=np.uint8)
+	compile_kernels()
+	_mean_kernel(block, horizontal, gray, GRAY, out)
+	return out
+
+def gaussian_rhythm_block(block, weights, windows, direction='H', gray=False):
+
+	# same output of VideoCapture.gaussian_rhythm_block, from bgr frames
+	horizontal = direction == 'H'
+	rows = block.shape[2] if horizontal else block.shape[1]
+	out = np.empty((rows, block.shape[0],
+					windows.shape[0]*(1 if gray else 3)), dtype=np.uint8)
+	compile_kernels()
+	_gaussian_kernel(block, horizontal, gray, GRAY, weights, windows, out)
+	return out
+
+def frame_tensor(flow_x, flow_y, direction='H'):
+
+	# same output of optical_rhythm.frame_tensor, from the bgr flow images
+	horizontal = direction == 'H'
+	rows = flow_x.shape[1] if horizontal else flow_x.shape[0]
+	out = np.empty((rows, 3), dtype=np.float64)
+	compile_kernels()
+	_tensor_kernel(flow_x, flow_y, horizontal, GRAY, out)
+	return out
+
+def check_kernels(trials=3, seed=0):
+
+	# compares the kernels with the numpy functions on random frames,
+	# returning the number of mismatches of each kernel
+	import cv2
+	import VideoCapture
+	import optical_rhythm
+
+	rng = np.random.RandomState(seed)
+	mismatches = {'mean': 0, 'gaussian': 0, 'tensor': 0}
+	for trial in range(trials):
+		n, height, width = rng.randint(1, 6), rng.randint(8, 60), rng.randint(8, 60)
+		block = rng.randint(0, 256, (n, height, width, 3)).astype(np.uint8)
+		gray = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+						 for frame in block])
+
+		for direction in VideoCapture.DIRECTION:
+			for color_mode in ['gray', 'rgb']:
+				frames = gray if color_mode == 'gray' else block
+				expected = VideoCapture.mean_rhythm_block(frames, direction)
+				result = mean_rhythm_block(block, direction,
+										   color_mode == 'gray')
+				mismatches['mean'] += not np.array_equal(expected, result)
+
+				percentil = sorted(rng.uniform(0, 1, rng.randint(1, 4)))
+				sigma, size = rng.uniform(0.5, 6), rng.randint(3, 20)
+				expected = VideoCapture.gaussian_rhythm_block(frames, sigma,
+								size, direction, percentil, color_mode)
+				weights, windows = VideoCapture.gaussian_windows(frames.shape[
+								VideoCapture.DIRECTION[direction] + 1], sigma,
+								size, percentil)
+				result = gaussian_rhythm_block(block, weights, windows,
+								direction, color_mode == 'gray')
+				mismatches['gaussian'] += not np.array_equal(expected, result)
+
+			expected = optical_rhythm.frame_tensor(gray[0], gray[-1],
+							direction, (height, width))
+			result = frame_tensor(block[0], block[-1], direction)
+			mismatches['tensor'] += not np.array_equal(expected, result)
+
+	return mismatches
+
+def _main(args):
+
+	if not USE_KERNELS:
+		print("Numba not found or gray conversion differs from OpenCV, the "
+			  "numpy functions are used")
+		return
+	mismatches = check_kernels(args.trials, args.seed)
+	print(mismatches)
+	if any(mismatches.values()):
+		exit(1)
+
+if __name__ == '__main__':
+	# parse arguments
+	args = _get_Args()
+	_main(args)
@@ -0,0 +1,341 @@
+import os
+import io
+import json
+import argparse
+import shutil
+import threading
+import numpy as np
+
+try:
+	from PIL import Image as pil_image
+except ImportError:
+	pil_image = None
+
+try:
+	from keras.utils import Sequence
+except ImportError:
+	Sequence = object
+
+# name of the index file of a store
+INDEX_FILE = "index.json"
+# size in bytes after which a new shard file is started
+SHARD_BYTES = 256*2**20
+
+def _get_Args():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("input", help="Directory with one folder per class or with set folders (training, valid, test) containing class folders")
+	parser.add_argument("output", help="Output directory of the store")
+	parser.add_argument("-ss", "--shard_size", help="Size of each shard in MB", type=int, default=SHARD_BYTES//2**20)
+	parser.add_argument("-d", "--dataset", help="Pack each set folder of input into its own store", action="store_true")
+	return parser.parse_args()
+
+def is_store(directory):
+
+	return os.path.isfile(os.path.join(directory, INDEX_FILE))
+
+def count_samples(directory):
+
+	# number of samples of a store or of a directory with class folders
+	if is_store(directory):
+		return len(ShardReader(directory))
+	return sum([len(files) for r, d, files in os.walk(directory)])
+
+def list_classes(directory):
+
+	if is_store(directory):
+		return ShardReader(directory).classes
+	return sorted(d for d in os.listdir(directory)
+				  if os.path.isdir(os.path.join(directory, d)))
+
+def sample_shape(data, ext):
+
+	# shape without decoding the whole sample
+	try:
+		if ext == '.npy':
+			f = io.BytesIO(data)
+			version = np.lib.format.read_magic(f)
+			if version == (1, 0):
+				shape, _, _ = np.lib.format.read_array_header_1_0(f)
+			elif version == (2, 0):
+				shape, _, _ = np.lib.format.read_array_header_2_0(f)
+			else:
+				return None
+			return list(shape)
+		if pil_image is not None:
+			img = pil_image.open(io.BytesIO(data))
+			return [img.size[1], img.size[0], len(img.getbands())]
+	except Exception:
+		pass
+	return None
+
+def pack_directory(indir, outdir, shard_size=SHARD_BYTES):
+
+	"""
+	Packs a directory with one folder per class into a few large shards
+
+	Args:
+	    indir (string): Directory with the class folders (any folders below
+				the class folder, like the R, G and B of ic rhythms, are kept
+				in the file name of the sample)
+		outdir (string): Output directory of the store
+		shard_size (int): Size in bytes after which a new shard is started
+
+	Returns:
+	    dict: The index of the store, also saved as index.json in outdir.
+				Each sample records its class, source video, shape, shard,
+				offset and size
+
+	"""
+
+	os.makedirs(outdir, exist_ok=True)
+	classes = list_classes(indir)
+	index = {'classes': classes, 'shards': [], 'samples': []}
+
+	shard = None
+	for _class in classes:
+		class_dir = os.path.join(indir, _class)
+		for root, dirs, files in sorted(os.walk(class_dir)):
+			dirs.sort()
+			for name in sorted(files):
+				with open(os.path.join(root, name), "rb") as f:
+					data = f.read()
+				if shard is None or shard.tell() + len(data) > shard_size and \
+				   shard.tell() > 0:
+					if shard is not None:
+						shard.close()
+					index['shards'].append("shard_{:05d}.bin".format(
+										   len(index['shards'])))
+					shard = open(os.path.join(outdir, index['shards'][-1]),
+								 "wb")
+				stem, ext = os.path.splitext(name)
+				index['samples'].append({
+					'class': _class,
+					'video': stem,
+					'file': os.path.relpath(os.path.join(root, name), indir),
+					'shape': sample_shape(data, ext),
+					'shard': len(index['shards']) - 1,
+					'offset': shard.tell(),
+					'size': len(data)
+				})
+				shard.write(data)
+	if shard is not None:
+		shard.close()
+
+	with open(os.path.join(outdir, INDEX_FILE), "w") as f:
+		json.dump(index, f)
+
+	return index
+
+def pack_dataset(indir, outdir, shard_size=SHARD_BYTES):
+
+	# packs each set folder (training, valid, test...) into its own store
+	os.makedirs(outdir, exist_ok=True)
+	for _set in sorted(os.listdir(indir)):
+		set_dir = os.path.join(indir, _set)
+		if os.path.isdir(set_dir):
+			pack_directory(set_dir, os.path.join(outdir, _set), shard_size)
+		elif _set.endswith('.json'):
+			# keeps the information files of the dataset
+			shutil.copy2(set_dir, os.path.join(outdir, _set))
+
+class ShardReader():
+
+	# reads samples of a store with random access, by position or by the file
+	# name they had before packing, or sequentially with iter()
+
+	def __init__(self, directory):
+
+		self.directory = directory
+		with open(os.path.join(directory, INDEX_FILE), "r") as f:
+			index = json.load(f)
+		self.classes = index['classes']
+		self.class_indices = dict(zip(self.classes, range(len(self.classes))))
+		self.shards = index['shards']
+		self.samples = index['samples']
+		self.files = {sample['file']: i for i, sample in enumerate(self.samples)}
+		self.handles = {}
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.samples)
+
+	def handle(self, shard):
+
+		with self.lock:
+			if shard not in self.handles:
+				self.handles[shard] = os.open(os.path.join(self.directory,
+										self.shards[shard]), os.O_RDONLY)
+			return self.handles[shard]
+
+	def read_bytes(self, i):
+
+		sample = self.samples[i]
+		# pread doesn't move a shared file position, so threads can share it
+		return os.pread(self.handle(sample['shard']), sample['size'],
+						sample['offset'])
+
+	def index_of(self, filename):
+
+		# accepts the file name relative to the store or joined with it
+		return self.files[os.path.relpath(filename, self.directory)
+						  if os.path.isabs(filename) or
+						  filename.startswith(self.directory) else filename]
+
+	def load_img(self, i, target_size=None, grayscale=False):
+
+		# same result of keras.preprocessing.image.load_img on the file
+		if pil_image is None:
+			raise ImportError('Could not import PIL.Image. '
+							  'The use of `load_img` requires PIL.')
+		img = pil_image.open(io.BytesIO(self.read_bytes(i)))
+		if grayscale:
+			if img.mode != 'L':
+				img = img.convert('L')
+		elif img.mode != 'RGB':
+			img = img.convert('RGB')
+		if target_size is not None:
+			size = (target_size[1], target_size[0])
+			if img.size != size:
+				img = img.resize(size, pil_image.NEAREST)
+		return img
+
+	def load_array(self, i):
+
+		sample = self.samples[i]
+		data = self.read_bytes(i)
+		if os.path.splitext(sample['file'])[1] == '.npy':
+			return np.load(io.BytesIO(data))
+		return np.asarray(self.load_img(i), dtype='float32')
+
+	def __iter__(self):
+
+		# streams the samples in the order they are stored, reading each
+		# shard once from the beginning to the end
+		by_shard = [[] for name in self.shards]
+		for sample in self.samples:
+			by_shard[sample['shard']].append(sample)
+		for name, samples in zip(self.shards, by_shard):
+			with open(os.path.join(self.directory, name), "rb") as f:
+				for sample in samples:
+					f.seek(sample['offset'])
+					yield sample, f.read(sample['size'])
+
+	def close(self):
+		with self.lock:
+			for fd in self.handles.values():
+				os.close(fd)
+			self.handles = {}
+
+class ShardIterator(Sequence):
+
+	# replaces the DirectoryIterator returned by flow_from_directory, yielding
+	# batches (x, y) of a store with the transformations and normalization of
+	# an ImageDataGenerator
+
+	def __init__(self, directory, image_data_generator, target_size=(256, 256),
+				 color_mode='rgb', batch_size=32, class_mode='categorical',
+				 shuffle=True, seed=None):
+
+		self.reader = ShardReader(directory)
+		self.image_data_generator = image_data_generator
+		self.target_size = tuple(target_size)
+		self.grayscale = color_mode == 'grayscale'
+		self.image_shape = self.target_size + ((1,) if self.grayscale else (3,))
+		self.batch_size = batch_size
+		self.class_mode = class_mode
+		self.shuffle = shuffle
+		self.seed = seed
+
+		self.class_indices = self.reader.class_indices
+		self.num_classes = len(self.reader.classes)
+		self.filenames = [sample['file'] for sample in self.reader.samples]
+		self.classes = np.array([self.class_indices[sample['class']]
+								 for sample in self.reader.samples],
+								dtype='int32')
+		self.samples = self.n = len(self.reader)
+		print('Found {} images belonging to {} classes in store.'.format(
+			  self.samples, self.num_classes))
+
+		self.epoch = 0
+		self.batch_index = 0
+		self.on_epoch_end()
+
+	def __len__(self):
+		return (self.n + self.batch_size - 1) // self.batch_size
+
+	def on_epoch_end(self):
+
+		self.index_array = np.arange(self.n)
+		if self.shuffle:
+			if self.seed is not None:
+				np.random.seed(self.seed + self.epoch)
+			self.index_array = np.random.permutation(self.n)
+		self.epoch += 1
+
+	def reset(self):
+		self.batch_index = 0
+
+	def __getitem__(self, idx):
+
+		index_array = self.index_array[idx*self.batch_size:
+									   (idx+1)*self.batch_size]
+		batch_x = np.zeros((len(index_array),) + self.image_shape,
+						   dtype='float32')
+		gen = self.image_data_generator
+		for j, i in enumerate(index_array):
+			img = self.reader.load_img(i, self.target_size, self.grayscale)
+			x = np.asarray(img, dtype='float32')
+			if x.ndim == 2:
+				x = np.expand_dims(x, axis=-1)
+			if gen is not None:
+				if hasattr(gen, 'get_random_transform'):
+					params = gen.get_random_transform(x.shape)
+					x = gen.apply_transform(x, params)
+				else:
+					x = gen.random_transform(x)
+				x = gen.standardize(x)
+			batch_x[j] = x
+
+		labels = self.classes[index_array]
+		if self.class_mode == 'categorical':
+			batch_y = np.zeros((len(batch_x), self.num_classes), dtype='float32')
+			batch_y[np.arange(len(batch_x)), labels] = 1.
+		elif self.class_mode in ('binary', 'sparse'):
+			batch_y = labels.astype('float32')
+		else:
+			return batch_x
+		return batch_x, batch_y
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+
+		# endless iteration, like keras iterators used by fit_generator
+		if self.batch_index >= len(self):
+			self.batch_index = 0
+			self.on_epoch_end()
+		self.batch_index += 1
+		return self[self.batch_index - 1]
+
+	next = __next__
+
+def flow_from(image_data_generator, directory, **kwargs):
+
+	# flow_from_directory that also accepts stores
+	if is_store(directory):
+		return ShardIterator(directory, image_data_generator, **kwargs)
+	return image_data_generator.flow_from_directory(directory, **kwargs)
+
+def _main(args):
+
+	if args.dataset:
+		pack_dataset(args.input, args.output, args.shard_size*2**20)
+	else:
+		pack_directory(args.input, args.output, args.shard_size*2**20)
+
+if __name__ == '__main__':
+	# parse arguments
+	args = _get_Args()
+	_main(args)
@@ -0,0 +1,120 @@
+import cv2
+import numpy as np
+import os
+import argparse
+import time
+
+from VideoCapture import rhythm_config, rhythm_block, open_video, BACKENDS
+
+def _get_Args():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("input", help = "Video file or camera index")
+	parser.add_argument("output", help = "Output dir")
+	parser.add_argument("-e", "--ext", help= "Extension of output", default=".jpg")
+	parser.add_argument("-w", "--window", help= "Number of frames (columns) of each rhythm window", type=int, default=224)
+	parser.add_argument("-st", "--step", help= "Number of new frames between two emitted windows", type=int, default=32)
+	parser.add_argument("-m", "--mode", help= "Capture mode", default="mean", choices=['mean', 'gaussian'])
+	parser.add_argument("-sg", "--sigma", type=float, help= "Standard deviation to use whitin gaussian filter")
+	parser.add_argument("-s", "--size", type=float, help= "Filter size")
+	parser.add_argument("-d", "--direction", help= "Visual rhythm direction", choices=["V", "H", "v", "h"], default='H')
+	parser.add_argument("-p", "--percentil", help= "Relative position to extract the rhythm", type=float, default=[0.5], nargs='+')
+	parser.add_argument("-c", "--color_mode", help= "Color mode", choices=['rgb', 'gray'], default='gray')
+	parser.add_argument("-b", "--backend", help="Library used to decode video files", choices=BACKENDS, default='cv2')
+	parser.add_argument("--fps", help="Play the video file at this rate, as a live feed would deliver it", type=float)
+
+	args = parser.parse_args()
+
+	if args.mode == 'gaussian' and (args.size is None or args.sigma is None):
+		parser.error("--mode gaussian requires --size and --sigma to be set.")
+
+	return args
+
+def frame_source(source, fps=None, backend='cv2'):
+
+	# a camera index opens a live capture, anything else is read as a file
+	if isinstance(source, int) or str(source).isdigit():
+		vid = cv2.VideoCapture(int(source))
+	else:
+		vid = open_video(source, backend)
+	if not vid.isOpened():
+		raise IOError("Unable to open video source {}".format(source))
+
+	interval = 1/fps if fps else 0
+	deadline = time.perf_counter()
+	try:
+		while True:
+			(flag, frame) = vid.read()
+			if not flag:
+				return
+			if interval:
+				# holds the frame until the time it would arrive on a feed
+				deadline += interval
+				time.sleep(max(deadline - time.perf_counter(), 0))
+			yield frame
+	finally:
+		vid.release()
+
+def stream_rhythm(frames, window, step, mode='mean', direction='H',
+				  sigma=None, size=None, percentil=[0.5], color_mode='gray'):
+
+	# frames is any iterator of bgr frames. A window with the rhythm of the
+	# last `window` frames is yielded every `step` frames, together with the
+	# number of frames seen so far. Each frame is reduced only once: the new
+	# frames are reduced as a block and written over the oldest columns of a
+	# ring buffer
+	config = rhythm_config(mode, direction, sigma, size, percentil, color_mode)
+	ring = None
+	block = None
+	pending = 0 # frames waiting on the block
+	seen = 0 # frames already written in the ring
+
+	for frame in frames:
+		if config['color_mode'] == 'gray' and frame.ndim == 3:
+			frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+		if block is None:
+			block = np.empty((step,) + frame.shape, dtype=np.uint8)
+		block[pending] = frame
+		pending += 1
+		if pending < step:
+			continue
+
+		cols = rhythm_block(block, config['mode'], config['direction'],
+							config['sigma'], config['size'],
+							config['percentil'], config['color_mode'])
+		if ring is None:
+			ring = np.zeros((cols.shape[0], window, cols.shape[2]),
+							dtype=np.uint8)
+		# when step is larger than the window only the newest columns stay
+		cols = cols[:,-window:]
+		index = np.arange(seen + step - cols.shape[1], seen + step) % window
+		ring[:,index] = cols
+		seen += step
+		pending = 0
+
+		if seen >= window:
+			head = seen % window # oldest column
+			yield seen, np.concatenate((ring[:,head:], ring[:,:head]), axis=1)
+
+def _main(args):
+
+	os.makedirs(args.output, exist_ok=True)
+	source = args.input
+	name = "camera{}".format(source) if str(source).isdigit() else \
+		   os.path.splitext(os.path.basename(source))[0]
+
+	frames = frame_source(source, args.fps, args.backend)
+	for seen, vr in stream_rhythm(frames, args.window, args.step, args.mode,
+						args.direction, args.sigma, args.size, args.percentil,
+						args.color_mode):
+		filename = os.path.join(args.output,
+								"{}_{:06d}{}".format(name, seen, args.ext))
+		if args.ext == ".npy":
+			np.save(filename, vr)
+		else:
+			cv2.imwrite(filename, vr)
+
+if __name__ == '__main__':
+	# parse arguments
+	args = _get_Args()
+	_main(args)
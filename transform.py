@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 import cv2
 import os
 from PIL import Image as pil_image
+from async_writer import shared_writer
 
 
 ##Data augmentation
@@ -168,7 +169,8 @@ def train_generator(batches, final_size, scale_ratios, channels, save_to_dir=Non
 			if(save_to_dir):
 				img = array_to_img(batch_crops[i], scale=True)
 				fname = 'aug_{index}_{hash}.{format}'.format(index=i, hash=np.random.randint(1e7), format=save_format)
-				img.save(os.path.join(save_to_dir, fname))				
+				# encoded on the writer threads while training goes on
+				shared_writer().save(os.path.join(save_to_dir, fname), img)
 
 		yield (batch_crops, batch_y)
 
@@ -185,7 +187,7 @@ def valid_generator(batches, final_size, channels, save_to_dir=None, save_format
 			if(save_to_dir):
 				img = array_to_img(batch_crops[i], scale=True)
 				fname = 'aug_{index}_{hash}.{format}'.format(index=i, hash=np.random.randint(1e7), format=save_format)
-				img.save(os.path.join(save_to_dir, fname))	
+				shared_writer().save(os.path.join(save_to_dir, fname), img)
 		
 		yield (batch_crops, batch_y)
 
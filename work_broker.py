@@ -0,0 +1,325 @@
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing as mp
+import multiprocessing.connection
+import socket
+import socketserver
+import threading
+import time
+from tqdm import tqdm
+
+import parallelize_script as ps
+from journal import Journal
+
+# seconds a worker holds an execution without renewing it, after which it
+# is given to another worker
+LEASE = 60.0
+PORT = 5555
+
+def _get_Args():
+
+	parser = argparse.ArgumentParser()
+	subparsers = parser.add_subparsers(dest="role")
+	subparsers.required = True
+
+	serve = subparsers.add_parser("serve", help="Serve the executions of the script to the workers")
+	serve.add_argument("script", help="Script name to run in parallel. It must be on the same path on the hosts of the workers")
+	serve.add_argument("files", help="Name of the file with the names of the input files for the script", nargs='+')
+	serve.add_argument("params", help="Name of the file with the extra parameters of script")
+	serve.add_argument("-H", "--host", help="Address the broker listens on. Use 0.0.0.0 to accept workers from other hosts", default="127.0.0.1")
+	serve.add_argument("-p", "--port", type=int, default=PORT)
+	serve.add_argument("-l", "--lease", type=float, help="Seconds a worker can hold an execution without renewing it", default=LEASE)
+	serve.add_argument("-o", "--order", help="Order the executions are given, like on parallelize_script", choices=['size', 'frames', 'input'], default='size')
+	serve.add_argument("-hf", "--history", help="Json file with the duration of the executions, like on parallelize_script")
+	serve.add_argument("-j", "--journal", help="Journal of the finished executions, like on parallelize_script")
+	serve.add_argument("-r", "--retries", type=int, help="Times a failed or lost execution is given again", default=ps.RETRIES)
+
+	work = subparsers.add_parser("work", help="Run the executions served by a broker")
+	work.add_argument("host", help="Address of the broker")
+	work.add_argument("-p", "--port", type=int, default=PORT)
+	work.add_argument("-np", "--processes", type=int, help="Number of worker processes on this host. Defaults to the number of cores")
+	work.add_argument("-sp", "--subprocess", help="Run each execution of the script on a new python process, instead of calling its _main on workers that import it once", action="store_true")
+
+	return parser.parse_args()
+
+def send(stream, message, lock=None):
+
+	# one json object per line
+	line = (json.dumps(message) + "\n").encode(ps.encode)
+	if lock is None:
+		stream.write(line)
+		stream.flush()
+		return
+	with lock:
+		stream.write(line)
+		stream.flush()
+
+def receive(stream):
+
+	line = stream.readline()
+	if not line:
+		raise ConnectionError("Connection closed")
+	return json.loads(line.decode(ps.encode))
+
+class Broker():
+
+	# state of the executions shared by the connections of the workers. Each
+	# execution given is leased to a connection until its result arrives,
+	# the lease expires or the connection drops, then it's queued again
+
+	def __init__(self, script, commands, names, order='size', lease=LEASE,
+				 retries=ps.RETRIES, history_file=None, journal_file=None):
+
+		self.script = script
+		self.commands = commands
+		self.keys = [" ".join(command) for command in commands]
+		self.lease = lease
+		self.retries = retries
+		self.history_file = history_file
+		self.history = ps.load_history(history_file)
+		self.journal = Journal(journal_file) if journal_file is not None \
+					   else None
+		self.lock = threading.Lock()
+		self.finished = threading.Event()
+
+		# index -> (connection, expiry)
+		self.leases = {}
+		self.codes, self.attempts = ps.resume_journal(self.journal, self.keys,
+													  retries)
+		costs = ps.estimate_costs(commands, [name[0] for name in names], order,
+								  self.history)
+		self.pending = collections.deque(sorted((index for index in
+										 range(len(commands)) if
+										 self.codes[index] is None),
+										 key=lambda index: -costs[index]))
+		self.pbar = tqdm(total=len(self.pending), ascii=True)
+		if not self.pending:
+			self.finished.set()
+
+	def next_task(self, connection):
+
+		with self.lock:
+			self._expire()
+			if not self.pending:
+				if self.leases:
+					# the running executions may still be given again
+					return {'wait': min(self.lease, 1.0)}
+				return {'done': True}
+			index = self.pending.popleft()
+			self.leases[index] = (connection, time.monotonic() + self.lease)
+			return {'task': index, 'command': self.commands[index]}
+
+	def renew(self, connection, index):
+
+		with self.lock:
+			if index in self.leases and self.leases[index][0] == connection:
+				self.leases[index] = (connection, time.monotonic() + self.lease)
+
+	def result(self, connection, index, code, duration):
+
+		with self.lock:
+			lease = self.leases.get(index)
+			if lease is None or lease[0] != connection:
+				# lost by this worker and given to another, whose result counts
+				if self.codes[index] is None and index in self.pending:
+					self.pending.remove(index)
+				else:
+					return
+			else:
+				del self.leases[index]
+			self._finish(index, code, duration)
+
+	def drop(self, connection):
+
+		# the connection of a worker closed, its executions are lost
+		with self.lock:
+			for index, (owner, expiry) in list(self.leases.items()):
+				if owner == connection:
+					del self.leases[index]
+					print("Lost {}".format(self.keys[index]))
+					self._finish(index, None, None)
+
+	def expire(self):
+
+		with self.lock:
+			self._expire()
+
+	def _expire(self):
+
+		now = time.monotonic()
+		for index, (owner, expiry) in list(self.leases.items()):
+			if expiry < now:
+				del self.leases[index]
+				print("Lease expired for {}".format(self.keys[index]))
+				self._finish(index, None, None)
+
+	def _finish(self, index, code, duration):
+
+		# lost executions (code None) count as failed attempts, so one that
+		# always kills its worker isn't given forever
+		self.attempts[index] += 1
+		ps.record_execution(self.journal, self.keys[index], code, duration,
+							self.attempts[index])
+		if code == 0:
+			self.history[self.keys[index]] = duration
+		elif self.attempts[index] <= self.retries:
+			self.pending.append(index)
+			return
+		self.codes[index] = code if code is not None else -1
+		self.pbar.update(1)
+		if not self.pending and not self.leases:
+			self.finished.set()
+
+	def close(self):
+
+		self.pbar.close()
+		if self.history_file is not None:
+			ps.save_history(self.history_file, self.history)
+		if self.journal is not None:
+			self.journal.close()
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+
+	# one thread for each worker connection
+	def handle(self):
+
+		broker = self.server.broker
+		connection = next(self.server.connections)
+		try:
+			while True:
+				message = receive(self.rfile)
+				op = message['op']
+				if op == 'hello':
+					send(self.wfile, {'script': broker.script,
+									  'lease': broker.lease})
+				elif op == 'get':
+					send(self.wfile, broker.next_task(connection))
+				elif op == 'renew':
+					broker.renew(connection, message['task'])
+				elif op == 'result':
+					broker.result(connection, message['task'], message['code'],
+								  message['duration'])
+		except (ConnectionError, OSError, ValueError):
+			pass
+		finally:
+			broker.drop(connection)
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+def serve(script, files, params, host="127.0.0.1", port=PORT, lease=LEASE,
+		  order='size', history_file=None, journal_file=None,
+		  retries=ps.RETRIES):
+
+	names = ps.get_files(files)
+	params = ps.get_params(params)
+	commands = ps.build_commands(script, names, params)
+
+	broker = Broker(script, commands, names, order, lease, retries,
+					history_file, journal_file)
+	server = BrokerServer((host, port), BrokerHandler)
+	server.broker = broker
+	# ids of the connections, never reused so late results are told apart
+	server.connections = itertools.count()
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	try:
+		# leases also expire while no worker asks for executions
+		while not broker.finished.wait(1.0):
+			broker.expire()
+		# the workers asking for more executions get done before the close
+		time.sleep(1.0)
+	finally:
+		server.shutdown()
+		server.server_close()
+		broker.close()
+
+	ps.print_failures(broker.codes, broker.keys, retries)
+	return broker.codes
+
+def work(host, port=PORT, in_process=True):
+
+	# one connection for each worker process. A thread renews the lease of
+	# the running execution, the main thread only reads the answers
+	try:
+		sock = socket.create_connection((host, port))
+	except OSError as e:
+		# unknown host, refused, unreachable or timed out. The process ends
+		# normally, so it isn't started again
+		print("A problem ocurred trying to connect to the broker: ", e)
+		return
+	stream = sock.makefile("rwb")
+	lock = threading.Lock()
+	try:
+		send(stream, {'op': 'hello'}, lock)
+		hello = receive(stream)
+		ps.init_worker(hello['script'], in_process)
+
+		while True:
+			send(stream, {'op': 'get'}, lock)
+			answer = receive(stream)
+			if answer.get('done'):
+				return
+			if 'wait' in answer:
+				time.sleep(answer['wait'])
+				continue
+
+			index = answer['task']
+			running = threading.Event()
+			def renew():
+				try:
+					while not running.wait(hello['lease']/3):
+						send(stream, {'op': 'renew', 'task': index}, lock)
+				except OSError:
+					# the result can't be sent either, the main thread ends
+					return
+			renewer = threading.Thread(target=renew, daemon=True)
+			renewer.start()
+			start = time.perf_counter()
+			try:
+				code = ps.run_script(answer['command'])
+			finally:
+				running.set()
+				renewer.join()
+			send(stream, {'op': 'result', 'task': index, 'code': code,
+						  'duration': time.perf_counter() - start}, lock)
+	except OSError:
+		# the broker finished or went away
+		return
+	finally:
+		stream.close()
+		sock.close()
+
+def _main(args):
+
+	if args.role == 'serve':
+		serve(args.script, args.files, args.params, args.host, args.port,
+			  args.lease, args.order, args.history, args.journal, args.retries)
+		return
+
+	# a worker killed by the script it runs is replaced, the broker gives
+	# its execution to another one
+	processes = args.processes or mp.cpu_count()
+	workers = []
+	while len(workers) < processes or workers:
+		for _ in range(processes - len(workers)):
+			worker = mp.Process(target=work, args=(args.host, args.port,
+												   not args.subprocess))
+			worker.start()
+			workers.append(worker)
+		mp.connection.wait([worker.sentinel for worker in workers])
+		for worker in [worker for worker in workers if not worker.is_alive()]:
+			workers.remove(worker)
+			worker.join()
+			if worker.exitcode == 0:
+				# the broker has no more executions
+				processes -= 1
+
+if __name__ == '__main__':
+	# parse arguments
+	args = _get_Args()
+	_main(args)